@@ -2,33 +2,104 @@
 from __future__ import division
 import os, sys
 import functools
-import json
+import thread
 import shlex
+import zlib
+from glob import glob
+from fnmatch import fnmatch
 import sublime, sublime_plugin
 from sublime import Region
-from os.path import dirname, relpath, exists
+from os.path import dirname, relpath
 
-from shebang import Task, AsyncProcess, Formatter, Multiplexer
+from shebang import Task, AsyncProcess, Formatter, LazyMultiplexer, venv_cache, view_index, view_state, metrics, \
+                    archived_runs, traceback_parser
 # import shebang.format
 # reload(shebang.format); Formatter = shebang.format.Formatter
 # import shebang.proc
 # reload(shebang.proc); Task = shebang.proc.Task; AsyncProcess = shebang.proc.AsyncProcess
 # import shebang.mux
-# reload(shebang.mux); Multiplexer = shebang.mux.Multiplexer
+# reload(shebang.mux); LazyMultiplexer = shebang.mux.LazyMultiplexer
+
+pool = LazyMultiplexer()
+
+def script_invocation(file_path, shebang, cmd=None, file_regex="", line_regex="", 
+                      working_dir="", encoding="utf-8", env={}, virtualenv=None, 
+                      path=None, build_env={}, **kwargs):
+    # work out how to run the script at file_path (whose first line is shebang)
+    if not working_dir:
+        try:
+            working_dir = dirname(file_path)
+        except:
+            working_dir = os.environ('HOME')
+    file_name = relpath(file_path, working_dir)
+    invocation=dict(arg_list=None, working_dir=working_dir, 
+                    env=env.copy(), encoding=encoding, path=path,
+                    file_regex=file_regex, line_regex=line_regex)
+    invocation['env'].update(build_env)
+    invocation.update(kwargs)
+        
+    # process the command param or create one from the file's shebang line
+    if cmd is None:
+        cmd = []
+        if shebang.startswith('#!'):
+            cmd = shlex.split(shebang[2:].encode('utf-8')) + [file_name]
+
+    # special handling if python is involved
+    if file_path.endswith('.py') or 'python' in str(cmd):
+        ve_python = closest_virtualenv(file_path, virtualenv)
+        if ve_python:
+            cmd = [relpath(ve_python, working_dir), '-u', file_name]
+
+        # default to the system path if no virtualenv was found and cmd wasn't 
+        # in the build system cfg
+        if not cmd:
+            cmd = ['/usr/bin/env','python','-u', file_name]
+
+        # turn off python's stdout buffering 
+        if 'python' in str(cmd) and '-u' not in cmd:
+            cmd.insert(-1,'-u')
+
+    # recognize the runtime's tracebacks (and point the output panel at them)
+    parser = traceback_parser(cmd, file_path)
+    if parser and not invocation['file_regex']:
+        invocation['file_regex'] = parser.file_regex
+
+    invocation['arg_list'] = cmd
+    return invocation
+
+def closest_virtualenv(file_path, ve_pattern):
+    if not ve_pattern:
+        # use the virtualenv defined in the settings file but let anything
+        # defined in a build setting override it
+        ve_pattern = pool._setting('virtualenv')
+        if not ve_pattern: return None
+
+    # the search results are cached per directory and pattern
+    ttl = pool._setting('virtualenv_cache_ttl')
+    return venv_cache.resolve(file_path, ve_pattern, ttl if ttl is not None else 300)
 
-pool = Multiplexer()
 class OutputViewWatcher(sublime_plugin.EventListener):
+    def on_new(self, view):
+        pool.view_opened(view)
+
+    def on_clone(self, view):
+        pool.view_opened(view)
+
+    def on_post_save(self, view):
+        pool.view_opened(view)
+
     def on_close(self, view):
         pool.view_closed(view)
 
     def on_load(self, view):
+        pool.view_opened(view)
         self._check_for_errors(view)
 
     def on_activated(self, view):
         self._check_for_errors(view)
 
     def _check_for_errors(self, view):
-        if view.settings().has('shebang.stacktrace') and pool.has_stacktrace(view):
+        if view_state.has(view, 'shebang.stacktrace') and pool.has_stacktrace(view):
             pool.formatter.flash_errors(view)
 
 class LastStackTraceCommand(sublime_plugin.WindowCommand):
@@ -37,7 +108,7 @@ class LastStackTraceCommand(sublime_plugin.WindowCommand):
         task_id = Task(view)
 
         if not task_id:
-            task_id = Task(*view.settings().get('shebang.stacktrace',{}).get('task',[]))
+            task_id = Task(*view_state.get(view, 'shebang.stacktrace', {}).get('task',[]))
 
         if task_id:
             pool.browse_stacktrace(task_id)
@@ -46,6 +117,138 @@ class LastStackTraceCommand(sublime_plugin.WindowCommand):
         return pool.has_stacktrace(self.window.active_view())
         
 
+class VirtualenvCacheCommand(sublime_plugin.WindowCommand):
+    def run(self, *args, **kwargs):
+        entries = venv_cache.items()
+        home = os.environ.get('HOME', '')
+        tilde = lambda path: path.replace(home,'~') if home else path
+        ui = [["Flush cache", "forget all %i cached virtualenv lookups"%len(entries)]]
+        for (dir_path, pattern), entry in entries:
+            found = tilde(entry['path']) if entry['path'] else "(not found)"
+            ui.append([u"%s: %s"%(tilde(dir_path or u''), pattern), found])
+
+        def _pick(idx):
+            if idx==0:
+                venv_cache.flush()
+            elif idx>0:
+                venv_cache.discard(entries[idx-1][0])
+        self.window.show_quick_panel(ui, _pick)
+
+
+class ArchivedRunsCommand(sublime_plugin.WindowCommand):
+    def run(self, *args, **kwargs):
+        # from an output view list its own task's runs, otherwise everyone's
+        task_id = Task(self.window.active_view())
+        pool.formatter.display_archive_menu(archived_runs(task_id))
+
+
+class SearchRunHistoryCommand(sublime_plugin.WindowCommand):
+    def run(self, query=None, **kwargs):
+        if query:
+            pool.search_history(query)
+        else:
+            self.window.show_input_panel("Search run output:", "", pool.search_history, None, None)
+
+
+class ShowMetricsCommand(sublime_plugin.WindowCommand):
+    def run(self, dump=False, reset=False, **kwargs):
+        if reset:
+            metrics.reset()
+        elif dump:
+            pool.formatter.display_metrics_dump(metrics.snapshot())
+        else:
+            pool.formatter.display_metrics(metrics.report())
+
+
+class RunBatchCommand(sublime_plugin.WindowCommand):
+    skip_dirs = set(['node_modules', 'bower_components', 'site-packages', 'dist-packages',
+                     '__pycache__', 'venv', 'virtualenv'])
+
+    def run(self, targets=None, limit=None, cancel=False, **kwargs):
+        if cancel:
+            return pool.cancel_batch()
+
+        targets = targets or pool._setting('batch_targets')
+        if targets:
+            self._run(targets, limit, kwargs)
+        else:
+            _run = lambda pattern: self._run([pattern.strip()], limit, kwargs)
+            self.window.show_input_panel("Run all scripts matching:", "*.py", _run, None, None)
+
+    def _run(self, patterns, limit, opts):
+        # walk the folders off the ui thread then queue up the jobs back on it
+        folders = self.window.folders()
+        def _find():
+            found = self._scripts(self._matches(patterns, folders))
+            sublime.set_timeout(functools.partial(self._queue, found, patterns, limit, opts), 0)
+        thread.start_new_thread(_find, ())
+
+    def _queue(self, found, patterns, limit, opts):
+        jobs = []
+        for file_path, shebang in found:
+            # use the script's view (if it's open) so the output lines up with
+            # a regular run. otherwise give it an id of its own to key its
+            # output buffer (-1 is reserved for shell commands)
+            views = view_index.file_views([file_path])
+            path_bytes = file_path.encode('utf-8') if isinstance(file_path, unicode) else file_path
+            view_id = views[0].id() if views else -2 - (zlib.crc32(path_bytes) & 0xffffff)
+            jobs.append((Task(file_path, view_id), script_invocation(file_path, shebang, **opts)))
+
+        if jobs:
+            pool.run_batch(jobs, limit)
+        else:
+            sublime.status_message("No scripts matching %s"%", ".join(patterns))
+
+    def _scripts(self, paths):
+        # the runnable files among paths, along with their shebang lines
+        found = []
+        for file_path in paths:
+            try:
+                with open(file_path) as f:
+                    shebang = f.readline().decode('utf-8', 'replace').rstrip()
+            except IOError:
+                continue
+            if file_path.endswith('.py') or shebang.startswith('#!'):
+                found.append((file_path, shebang))
+        return found
+
+    def _matches(self, patterns, folders):
+        # patterns are either absolute globs or fnmatch patterns matched against
+        # paths relative to the window's folders ('**/' also matches at the top).
+        # hidden directories and installed dependencies are left out of the walk
+        found, seen = [], set()
+        for pattern in patterns:
+            pattern = os.path.expanduser(pattern)
+            if os.path.isabs(pattern):
+                matches = sorted(glob(pattern))
+            else:
+                matches = []
+                alt = pattern[3:] if pattern.startswith('**/') else pattern
+                for folder in folders:
+                    for root, dirs, files in os.walk(folder):
+                        dirs[:] = sorted(d for d in dirs if not (d.startswith('.') or d in self.skip_dirs))
+                        for name in sorted(files):
+                            rel = relpath(os.path.join(root, name), folder)
+                            if fnmatch(rel, pattern) or fnmatch(rel, alt):
+                                matches.append(os.path.join(root, name))
+            for path in matches:
+                if path not in seen:
+                    seen.add(path)
+                    found.append(path)
+        return found
+
+    def is_enabled(self, cancel=False, **kwargs):
+        return pool.batch_running() if cancel else True
+
+
+class BrowseFullOutputCommand(sublime_plugin.WindowCommand):
+    def run(self, *args, **kwargs):
+        pool.browse_output(self.window.active_view())
+
+    def is_enabled(self):
+        return pool.has_spool(self.window.active_view())
+
+
 class ExecuteCommand(sublime_plugin.WindowCommand):
     def run(self, cmd = None, file_regex = "", line_regex = "", working_dir = "",
             encoding = "utf-8", env = {}, quiet = False, kill = False, 
@@ -61,46 +264,14 @@ class ExecuteCommand(sublime_plugin.WindowCommand):
         view = self.window.active_view()
         file_path = view.file_name()
         task_id = Task(file_path, view.id())
-        if not working_dir:
-            try:
-                working_dir = dirname(file_path)
-            except:
-                working_dir = os.environ('HOME')
-        file_name = relpath(file_path, working_dir)
-        invocation=dict(arg_list=None, working_dir=working_dir, 
-                        env=env.copy(), encoding=encoding, path=path,
-                        file_regex=file_regex, line_regex=line_regex)
-        invocation['env'].update(view.settings().get('build_env',{}))
-        invocation.update(kwargs)
-        
+
         # catch ctrl-c
         if kill: return pool.stop_worker(task_id)
-            
-        # process the command param or create one from the file's shebang line
-        if cmd is None:
-            cmd = []
-            shebang = view.substr(view.line(0))
-            if shebang.startswith('#!'):
-                cmd = shlex.split(shebang[2:].encode('utf-8')) + [file_name]
-
-        # special handling if python is involved
-        if file_path.endswith('.py') or 'python' in str(cmd):
-            if not invocation['file_regex']:
-                invocation['file_regex'] =  "^[ ]*File \"(...*?)\", line ([0-9]*)"
-            ve_python = self._closest_virtualenv(file_path, virtualenv)
-            if ve_python:
-                cmd = [relpath(ve_python, working_dir), '-u', file_name]
-
-            # default to the system path if no virtualenv was found and cmd wasn't 
-            # in the build system cfg
-            if not cmd:
-                cmd = ['/usr/bin/env','python','-u', file_name]
-
-            # turn off python's stdout buffering 
-            if 'python' in str(cmd) and '-u' not in cmd:
-                cmd.insert(-1,'-u')
-
-        invocation['arg_list'] = cmd
+
+        invocation = script_invocation(file_path, view.substr(view.line(0)), cmd, 
+                                       file_regex, line_regex, working_dir, encoding,
+                                       env, virtualenv, path, view.settings().get('build_env',{}),
+                                       **kwargs)
         if pool._setting('save_on_run'):
             if view.is_dirty(): 
                 view.run_command('save')
@@ -113,7 +284,7 @@ class ExecuteCommand(sublime_plugin.WindowCommand):
     def _cached_run(self, prompt, kill):
         view = self.window.active_view()
         task_id = Task(view)
-        task_inv = json.loads(view.settings().get("shebang.invocation", '{}'))
+        task_inv = dict(view_state.get(view, "shebang.invocation", {}))
         if task_id and task_inv:
             if prompt: 
                 self._prompt_then_run(task_id, task_inv)
@@ -144,37 +315,6 @@ class ExecuteCommand(sublime_plugin.WindowCommand):
             prompt_str = u"%s…%s"%(prompt_str[:24], prompt_str[-24:])
         sublime.active_window().show_input_panel("%s %%"%prompt_str, _spawn.quoted, _spawn, None, None)
 
-    def _closest_virtualenv(self, file_path, ve_pattern):
-        if not ve_pattern:
-            # use the virtualenv defined in the settings file but let anything
-            # defined in a build setting override it
-            ve_pattern = pool._setting('virtualenv')
-            if not ve_pattern: return None
-
-        ve_binary = os.path.join(ve_pattern,'bin','python')
-        if ve_binary[0] in '~/':
-            # try using the virtualenv config string as an absolute path...
-            ve_pth = ve_binary.replace('~',os.environ.get('HOME','~'))
-            if exists(ve_pth):
-                return ve_pth
-        else:
-            # ...otherwise keep stepping up from the file_path's dir looking 
-            # for a folder with a name matching the config string
-            for ve_pth in self._parents(file_path, ve_binary):
-                if exists(ve_pth):
-                    return ve_pth
-
-    def _parents(self, file_path, sub_path=None):
-        dirs = []
-        parent_dir = dirname(file_path)
-        while True:
-            if sub_path: dirs.append(os.path.join(parent_dir, sub_path))
-            else: dirs.append(parent_dir)
-            new_dir = dirname(parent_dir)
-            if parent_dir == new_dir: break
-            parent_dir = new_dir
-        return dirs
-
     def is_enabled(self, restart=False, kill=False, prompt=False, *args, **kwargs):
         if prompt: return True
         view = self.window.active_view()
@@ -0,0 +1,45 @@
+# encoding: utf-8
+# the child side of the benchmark: writes `size` bytes to stdout in one of the
+# patterns below. every record starts with a '@<time.time()> ' stamp so the
+# parent can work out how long it took to go from this write to the view
+import os, sys, time
+
+FILL = u'the quick brown fox jumps over the lazy dog. '
+UNI = u'Grüße · 東京 · Ελληνικά · ☃ · 🐍 '
+
+def records(pattern):
+    # yields (text, bytes to write per os.write call, pause after each write)
+    if pattern == 'steady':
+        # short lines, one write per line, at a fixed rate
+        return lambda: u'%s\n'%(FILL*2), 1, 0.0001
+    if pattern == 'burst':
+        # a few hundred kilobytes at once then nothing for a while
+        return lambda: u'%s\n'%(FILL*2), 2000, 0.1
+    if pattern == 'long':
+        # lines of a quarter megabyte each
+        return lambda: u'%s\n'%(FILL*5800), 1, 0
+    if pattern == 'progress':
+        # a carriage-return-rewritten status line
+        return lambda: u'[%-40s]\r'%('#'*int(time.time()*100%40)), 100, 0.001
+    if pattern == 'unicode':
+        # multibyte characters, which can land split across reads
+        return lambda: u'%s\n'%(UNI*4), 1, 0
+    raise SystemExit('unknown pattern: %s'%pattern)
+
+def main(pattern, size):
+    record, per_write, pause = records(pattern)
+    out, written = sys.stdout.fileno(), 0
+    while written < size:
+        batch = []
+        for i in range(per_write):
+            batch.append((u'@%.6f '%time.time() + record()).encode('utf-8'))
+        data = b''.join(batch)
+        while data:
+            n = os.write(out, data)
+            written += n
+            data = data[n:]
+        if pause: time.sleep(pause)
+    os.write(out, b'\n')
+
+if __name__ == '__main__':
+    main(sys.argv[1], int(sys.argv[2]))
@@ -0,0 +1,141 @@
+# encoding: utf-8
+# measures the output pipeline (AsyncProcess -> Multiplexer.on_data -> _flush
+# -> Formatter.append_txt) outside of the editor, using the stand-in sublime
+# module in this directory and real child processes (see emit.py). each
+# pattern runs in a fresh interpreter so its peak memory is its own:
+#
+#   python bench/run.py [-p steady,burst,...] [-s MB] [-n procs] [--set key=json] [--json]
+import os, sys, re, json, time
+import shutil
+import resource
+import tempfile
+import subprocess
+from optparse import OptionParser, SUPPRESS_HELP
+from os.path import dirname, abspath, join
+
+BENCH_DIR = dirname(abspath(__file__))
+PATTERNS = ['steady', 'burst', 'long', 'progress', 'unicode']
+
+class Probe(object):
+    # picks the stamps emit.py put at the start of each record out of the text
+    # as it's inserted, keeping the tail of the last insert in case one of them
+    # was split between two flushes
+    re_stamp = re.compile(u'@(\\d+\\.\\d{6}) ')
+
+    def __init__(self):
+        self.carry = {}
+        self.latencies = []
+
+    def __call__(self, view, txt):
+        now = time.time()
+        carry = self.carry.get(view.id(), u'')
+        buf = carry + txt
+        for m in self.re_stamp.finditer(buf):
+            if m.end() > len(carry):
+                self.latencies.append(now - float(m.group(1)))
+        self.carry[view.id()] = buf[-24:]
+
+def percentile(vals, pct):
+    if not vals: return 0.0
+    return vals[min(len(vals)-1, int(len(vals)*pct/100.0))]
+
+def measure(pattern, size, procs, timeout):
+    # runs `procs` copies of the pattern at once in this process and returns the stats
+    sys.path.insert(0, dirname(BENCH_DIR))
+    import sublime
+    from shebang import Multiplexer, Task
+
+    probe = Probe()
+    sublime.View.on_insert = probe
+    win = sublime.active_window()
+    emit_py = join(BENCH_DIR, 'emit.py')
+    win.open_file(emit_py)
+
+    log, sys.stdout = sys.stdout, open(os.devnull, 'w') # the plugin's own chatter
+    try:
+        pool = Multiplexer()
+        sublime.run_loop(lambda: False, timeout=0.2) # let the startup sweep finish
+        sublime.stats.update(callbacks=0, ui_time=0.0)
+
+        tasks = [Task(emit_py, -2-i) for i in range(procs)]
+        start = time.time()
+        for task_id in tasks:
+            pool.spawn_worker(task_id, dict(arg_list=[sys.executable, emit_py, pattern, str(size)],
+                                            working_dir=BENCH_DIR, env={}, encoding='utf-8', path=None,
+                                            file_regex='', line_regex=''))
+        done = sublime.run_loop(lambda: not any(t in pool._procs for t in tasks), timeout)
+        elapsed = time.time() - start
+    finally:
+        sys.stdout = log
+
+    nbytes = 0
+    for task_id in tasks:
+        info = json.loads(pool.output_view(task_id).settings().get('shebang.invocation', '{}'))
+        nbytes += info.get('last_run', {}).get('size', 0)
+    mb = nbytes / float(2**20)
+    lat = sorted(probe.latencies)
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return dict(pattern=pattern, procs=procs, completed=done, bytes=nbytes,
+                elapsed=elapsed, throughput=nbytes/elapsed if elapsed else 0.0,
+                p50=percentile(lat, 50), p99=percentile(lat, 99), records=len(lat),
+                callbacks=sublime.stats['callbacks'],
+                callbacks_per_mb=sublime.stats['callbacks']/mb if mb else 0.0,
+                ui_time=sublime.stats['ui_time'],
+                peak_rss=maxrss*(1 if sys.platform=='darwin' else 1024))
+
+def report(results):
+    print "%-9s %8s %9s %9s %9s %11s %8s %9s"%('pattern', 'MB', 'MB/s', 'p50 ms', 'p99 ms',
+                                              'calls/MB', 'ui s', 'peak MB')
+    for r in results:
+        print "%-9s %8.1f %9.2f %9.2f %9.2f %11.1f %8.2f %9.1f%s"%(
+              r['pattern'], r['bytes']/2.0**20, r['throughput']/2.0**20, r['p50']*1000, r['p99']*1000,
+              r['callbacks_per_mb'], r['ui_time'], r['peak_rss']/2.0**20,
+              '' if r['completed'] else '  (timed out)')
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('-p', '--patterns', default=','.join(PATTERNS),
+                      help="comma-separated list of: %s"%', '.join(PATTERNS))
+    parser.add_option('-s', '--size', type='float', default=8, help="MB written by each child")
+    parser.add_option('-n', '--procs', type='int', default=1, help="children running at once")
+    parser.add_option('-t', '--timeout', type='float', default=120, help="seconds to wait per pattern")
+    parser.add_option('--set', action='append', default=[], metavar='KEY=JSON',
+                      help="override a Shebang.sublime-settings value (repeatable)")
+    parser.add_option('--json', action='store_true', help="print the results as json")
+    parser.add_option('--only', help=SUPPRESS_HELP)
+    opts, args = parser.parse_args()
+
+    if opts.only:
+        # the child side of main(): run a single pattern and hand back the stats.
+        # the plugin's files (the run registry, index, and archive) go in a
+        # throwaway home rather than the real ~/.shebang
+        home = os.environ['HOME'] = tempfile.mkdtemp(prefix='shebang-bench-')
+        try:
+            import sublime
+            for kv in opts.set:
+                key, val = kv.split('=', 1)
+                sublime.overrides[key] = json.loads(val)
+            r = measure(opts.only, int(opts.size*2**20), opts.procs, opts.timeout)
+        finally:
+            shutil.rmtree(home, ignore_errors=True)
+        print json.dumps(r)
+        return
+
+    results = []
+    for pattern in opts.patterns.split(','):
+        if pattern not in PATTERNS:
+            parser.error("unknown pattern: %s"%pattern)
+        cmd = [sys.executable, abspath(__file__), '--only', pattern, '-s', str(opts.size),
+               '-n', str(opts.procs), '-t', str(opts.timeout)]
+        for kv in opts.set:
+            cmd += ['--set', kv]
+        out = subprocess.Popen(cmd, stdout=subprocess.PIPE).communicate()[0]
+        results.append(json.loads(out.strip().splitlines()[-1]))
+
+    if opts.json:
+        print json.dumps(results, indent=2)
+    else:
+        report(results)
+
+if __name__ == '__main__':
+    main()
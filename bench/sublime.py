@@ -0,0 +1,295 @@
+# encoding: utf-8
+# a stand-in for the editor's sublime module that's just complete enough to
+# drive the shebang package headlessly. set_timeout callbacks are queued and
+# run by run_loop() on the calling (i.e., 'ui') thread, and views keep their
+# text in memory
+import os, re, json, time
+import heapq, itertools, thread
+
+DRAW_OUTLINED = 1
+HIDDEN = 2
+ENCODED_POSITION = 1
+
+_queue = []
+_lock = thread.allocate_lock()
+_seq = itertools.count()
+stats = dict(callbacks=0, ui_time=0.0)
+
+def set_timeout(fn, ms):
+    with _lock:
+        heapq.heappush(_queue, (time.time() + ms/1000.0, next(_seq), fn))
+
+def run_loop(until, timeout=60):
+    # run due callbacks until until() is true (or the timeout runs out)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        with _lock:
+            due = _queue and _queue[0][0] <= time.time()
+            item = heapq.heappop(_queue) if due else None
+        if item:
+            t = time.time()
+            item[2]()
+            stats['callbacks'] += 1
+            stats['ui_time'] += time.time() - t
+        elif until():
+            return True
+        else:
+            time.sleep(0.0005)
+    return False
+
+class Region(object):
+    def __init__(self, a, b=None):
+        self.a, self.b = a, a if b is None else b
+    def begin(self): return min(self.a, self.b)
+    def end(self): return max(self.a, self.b)
+    def size(self): return abs(self.b - self.a)
+    def empty(self): return self.a == self.b
+    def __eq__(self, other):
+        return isinstance(other, Region) and (self.a, self.b) == (other.a, other.b)
+    def __ne__(self, other): return not self == other
+    def __repr__(self): return 'Region(%i, %i)'%(self.a, self.b)
+
+class Settings(object):
+    def __init__(self, values=None):
+        self.values = dict(values or {})
+    def get(self, key, default=None): return self.values.get(key, default)
+    def set(self, key, value): self.values[key] = value
+    def has(self, key): return key in self.values
+    def erase(self, key): self.values.pop(key, None)
+
+class Selection(list):
+    def add(self, r): self.append(r)
+    def clear(self): del self[:]
+
+_ids = itertools.count(1)
+
+class View(object):
+    # appends (by far the most common edit) are just pushed onto a list of
+    # chunks, which are only joined once something needs to look at the text
+    on_insert = None # optional hook called as on_insert(view, txt) after each insert
+
+    def __init__(self, window, file_name=None):
+        self._id = next(_ids)
+        self._window = window
+        self._file_name = file_name
+        self._chunks, self._size = [], 0
+        self._settings = Settings()
+        self._sel = Selection([Region(0)])
+        self._regions = {}
+        self._status = {}
+        self.name = u''
+        self.read_only = False
+        self.changes = 0
+        self.folds = []
+
+    def _text(self):
+        if len(self._chunks) > 1:
+            self._chunks = [u''.join(self._chunks)]
+        return self._chunks[0] if self._chunks else u''
+
+    def _set_text(self, txt):
+        self._chunks, self._size = [txt], len(txt)
+        self.changes += 1
+
+    def id(self): return self._id
+    def window(self): return self._window
+    def file_name(self): return self._file_name
+    def settings(self): return self._settings
+    def size(self): return self._size
+    def sel(self): return self._sel
+    def is_loading(self): return False
+    def is_dirty(self): return False
+    def is_read_only(self): return self.read_only
+    def set_read_only(self, flag): self.read_only = flag
+    def set_scratch(self, flag): pass
+    def set_syntax_file(self, path): pass
+    def set_name(self, name): self.name = name
+    def set_status(self, key, val): self._status[key] = val
+    def erase_status(self, key): self._status.pop(key, None)
+    def get_status(self, key): return self._status.get(key)
+    def change_count(self): return self.changes
+    def begin_edit(self, *args): return object()
+    def end_edit(self, edit): pass
+    def show(self, *args): pass
+    def show_at_center(self, *args): pass
+    def viewport_extent(self): return (960.0, 640.0)
+    def em_width(self): return 8.0
+    def line_height(self): return 16.0
+
+    def substr(self, r):
+        if isinstance(r, int): return self._text()[r:r+1]
+        return self._text()[r.begin():r.end()]
+
+    def _shift(self, pt, delta, end=None):
+        # move the regions past an edit along with the text (an erase of
+        # [pt, end) collapses any points inside it to pt)
+        for key, regions in self._regions.items():
+            moved = []
+            for r in regions:
+                a, b = r.a, r.b
+                if end is None:
+                    a, b = [p+delta if p > pt else p for p in (a, b)]
+                else:
+                    a, b = [p+delta if p >= end else (pt if p > pt else p) for p in (a, b)]
+                moved.append(Region(a, b))
+            self._regions[key] = moved
+
+    def insert(self, edit, pt, txt):
+        if self._regions:
+            self._shift(pt, len(txt))
+        if pt == self._size:
+            self._chunks.append(txt)
+            self._size += len(txt)
+            self.changes += 1
+        else:
+            t = self._text()
+            self._set_text(t[:pt] + txt + t[pt:])
+        if self.on_insert:
+            self.on_insert(self, txt)
+        return len(txt)
+
+    def erase(self, edit, r):
+        if self._regions:
+            self._shift(r.begin(), -r.size(), r.end())
+        t = self._text()
+        self._set_text(t[:r.begin()] + t[r.end():])
+
+    def replace(self, edit, r, txt):
+        if self._regions:
+            self._shift(r.begin(), -r.size(), r.end())
+            self._shift(r.begin(), len(txt))
+        t = self._text()
+        self._set_text(t[:r.begin()] + txt + t[r.end():])
+
+    def run_command(self, cmd, args=None):
+        if cmd == 'move_to':
+            self._sel[:] = [Region(self._size)]
+
+    def fold(self, regions):
+        self.folds.append(regions)
+    def unfold(self, regions):
+        pass
+
+    def add_regions(self, key, regions, *args):
+        self._regions[key] = list(regions)
+    def get_regions(self, key):
+        return list(self._regions.get(key, []))
+    def erase_regions(self, key):
+        self._regions.pop(key, None)
+
+    def line(self, pt):
+        if isinstance(pt, Region): pt = pt.a
+        t = self._text()
+        a = t.rfind(u'\n', 0, pt) + 1
+        b = t.find(u'\n', pt)
+        return Region(a, len(t) if b < 0 else b)
+
+    def rowcol(self, pt):
+        t = self._text()
+        return (t.count(u'\n', 0, pt), pt - (t.rfind(u'\n', 0, pt) + 1))
+
+    def text_point(self, row, col):
+        t, pos = self._text(), 0
+        for i in xrange(row):
+            nl = t.find(u'\n', pos)
+            if nl < 0: return len(t)
+            pos = nl + 1
+        return pos + col
+
+    def split_by_newlines(self, r):
+        regions, pos = [], r.begin()
+        for ln in self.substr(r).split(u'\n'):
+            regions.append(Region(pos, pos+len(ln)))
+            pos += len(ln) + 1
+        return regions
+
+    # the scopes the Output syntax would assign, approximated by regexes. the
+    # grammar's top-level rules (like the one that also marks the cmd:, dir:,
+    # and path: preamble lines as headers) only apply outside of run bodies
+    _scopes = {'comment.header.shebang':u'\u200b([^\u200c]*)',
+               'output.shebang':u'\u200c([^\u200d]*)',
+               'keyword.pid.shebang':u'\u200b[^\u200c]*\\[(\\d+)\\]'}
+    _toplevel = {'comment.header.shebang':u'(?m)^(\\s*\\w+\\:)'}
+    def find_by_selector(self, selector):
+        txt = self._text()
+        found = [Region(m.start(1), m.end(1)) for m in re.finditer(self._scopes[selector], txt)]
+        if selector in self._toplevel:
+            bodies = self.find_by_selector('output.shebang')
+            for m in re.finditer(self._toplevel[selector], txt):
+                if not any(b.a <= m.start(1) < b.b for b in bodies):
+                    found.append(Region(m.start(1), m.end(1)))
+            found.sort(key=lambda r: r.a)
+        return found
+
+class Window(object):
+    def __init__(self):
+        self._id = next(_ids)
+        self._views = []
+        self._active = None
+        self._folders = []
+        self.panels = {}
+        self.quick_panel = None
+
+    def id(self): return self._id
+    def views(self): return list(self._views)
+    def folders(self): return list(self._folders)
+    def active_view(self): return self._active or (self._views and self._views[-1]) or None
+
+    def new_file(self):
+        view = View(self)
+        self._views.append(view)
+        self._active = view
+        _fire('on_new', view)
+        return view
+
+    def open_file(self, path, flags=0):
+        if flags & ENCODED_POSITION:
+            path = path.rsplit(':', 1)[0]
+        view = View(self, path)
+        self._views.append(view)
+        self._active = view
+        _fire('on_load', view)
+        return view
+
+    def close(self, view):
+        self._views.remove(view)
+        view._window = None
+        if self._active is view: self._active = None
+        _fire('on_close', view)
+
+    def get_output_panel(self, name):
+        return self.panels.setdefault(name, View(None))
+
+    def run_command(self, cmd, args=None): pass
+    def focus_view(self, view): self._active = view
+    def show_quick_panel(self, items, on_done, *args): self.quick_panel = (items, on_done)
+    def show_input_panel(self, caption, initial, on_done, on_change, on_cancel): pass
+
+listeners = []
+def _fire(event, view):
+    for listener in listeners:
+        if hasattr(listener, event):
+            getattr(listener, event)(view)
+
+_windows = [Window()]
+def windows(): return list(_windows)
+def active_window(): return _windows[0]
+def run_command(cmd, args=None): pass
+def status_message(msg): pass
+def ok_cancel_dialog(msg, ok_title=''): return True
+def error_message(msg): print msg
+def packages_path(): return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Packages')
+
+_settings = {}
+overrides = {}
+def load_settings(name):
+    if name not in _settings:
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        with open(os.path.join(root, name)) as f:
+            raw = f.read()
+        raw = re.sub(r'(?m)^\s*//.*$', '', raw) # drop the comments
+        raw = re.sub(r'(?m)//[^"\n]*$', '', raw)
+        values = json.loads(raw)
+        values.update(overrides)
+        _settings[name] = Settings(values)
+    return _settings[name]
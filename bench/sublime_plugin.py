@@ -0,0 +1,14 @@
+# the base classes Commands.py subclasses, minus everything the benchmark doesn't touch
+class EventListener(object):
+    pass
+
+class ApplicationCommand(object):
+    pass
+
+class WindowCommand(object):
+    def __init__(self, window):
+        self.window = window
+
+class TextCommand(object):
+    def __init__(self, view):
+        self.view = view
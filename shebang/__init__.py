@@ -1,3 +1,9 @@
 from proc import AsyncProcess, Task
+from trace import traceback_parser
 from format import Formatter
-from mux import Multiplexer
+from mux import Multiplexer, LazyMultiplexer
+from venv import venv_cache
+from index import view_index
+from state import view_state
+from metrics import metrics
+from archive import archived_runs
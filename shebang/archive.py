@@ -0,0 +1,71 @@
+# encoding: utf-8
+import os
+import gzip
+import json
+import time
+import thread
+from hashlib import md5
+
+ARCHIVE_DIR = os.path.join(os.path.expanduser('~'), '.shebang', 'archive')
+_lock = thread.allocate_lock()
+
+# runs that have been moved out of an output view once it holds more than
+# keep_runs of them. each task gets a directory with one gzipped file per run
+# and an index.json listing them (oldest first) along with the invocation and
+# how the run went. the writing happens off the ui thread
+def archive_runs(task_id, runs):
+    # runs is a list of (text, meta) pairs
+    thread.start_new_thread(_write, (list(task_id), runs))
+
+def _write(task, runs):
+    tag = md5(json.dumps(task)).hexdigest()[:12]
+    task_dir = os.path.join(ARCHIVE_DIR, tag)
+    with _lock:
+        try:
+            if not os.path.isdir(task_dir):
+                os.makedirs(task_dir)
+            index = _read_index(task_dir)
+            for txt, meta in runs:
+                stamp = meta.get('started') or time.time()
+                name = '%s-%i.txt.gz'%(time.strftime('%Y%m%d-%H%M%S', time.localtime(stamp)), len(index))
+                f = gzip.open(os.path.join(task_dir, name), 'wb')
+                try:
+                    f.write(txt.encode('utf-8'))
+                finally:
+                    f.close()
+                index.append(dict(meta, task=task, file=name))
+            with open(os.path.join(task_dir, 'index.json'), 'w') as f:
+                json.dump(index, f)
+        except (IOError, OSError) as e:
+            print "Couldn't archive runs of %s: %s"%(task[0], e)
+
+def _read_index(task_dir):
+    try:
+        with open(os.path.join(task_dir, 'index.json')) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return []
+
+def archived_runs(task_id=None):
+    # every archived run (or just those of one task), newest first. each entry
+    # has a 'dir' alongside its metadata for passing to read_archived
+    if task_id:
+        tags = [md5(json.dumps(list(task_id))).hexdigest()[:12]]
+    elif os.path.isdir(ARCHIVE_DIR):
+        tags = os.listdir(ARCHIVE_DIR)
+    else:
+        tags = []
+    with _lock:
+        entries = []
+        for tag in tags:
+            task_dir = os.path.join(ARCHIVE_DIR, tag)
+            entries.extend(dict(entry, dir=task_dir) for entry in _read_index(task_dir))
+    entries.sort(key=lambda e: -(e.get('started') or 0))
+    return entries
+
+def read_archived(entry):
+    f = gzip.open(os.path.join(entry['dir'], entry['file']), 'rb')
+    try:
+        return f.read().decode('utf-8', 'replace')
+    finally:
+        f.close()
@@ -0,0 +1,173 @@
+# encoding: utf-8
+# the warm-start server (see warm.py). it's run by the script's own python
+# rather than the editor's, imports the modules named on its command line
+# once, then forks a copy of itself for each run it's asked to do. since it
+# runs under whichever python the script uses, keep it valid for 2 and 3
+import os, sys
+import json
+import errno
+import signal
+import socket
+import runpy
+import atexit
+import traceback
+
+def serve(sock_path, modules):
+    # don't let the package's own modules shadow the stdlib (or the script's)
+    del sys.path[0]
+    for mod in modules:
+        try:
+            __import__(mod)
+        except Exception as e:
+            sys.stderr.write("Couldn't preload %s: %s\n"%(mod, e))
+
+    # the socket only appears at sock_path once the imports are done, so a
+    # client that can connect knows the server is ready for it
+    editor = os.getppid()
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    tmp_path = '%s.%i'%(sock_path, os.getpid())
+    listener.bind(tmp_path)
+    listener.listen(16)
+    os.rename(tmp_path, sock_path)
+    listener.settimeout(5)
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+
+    # stick around until the editor that started us goes away
+    while os.getppid() == editor:
+        try:
+            conn, _ = listener.accept()
+        except socket.timeout:
+            continue
+        except socket.error as e:
+            if e.args[0] == errno.EINTR: continue
+            raise
+        if not os.fork():
+            listener.close()
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            try:
+                conn.settimeout(None)
+                wait_on(conn)
+            finally:
+                os._exit(0)
+        conn.close()
+
+    try:
+        os.remove(sock_path)
+    except OSError:
+        pass
+
+def wait_on(conn):
+    # read the request, start the run, and report back its pid then (once
+    # it's been reaped) its exit status and resource usage
+    req = json.loads(conn.makefile('rb').readline().decode('utf-8'))
+    out = os.open(req['out'], os.O_WRONLY)
+    err = os.open(req['err'], os.O_WRONLY) if req.get('err') else out
+
+    pid = os.fork()
+    if not pid:
+        conn.close()
+        run(req, out, err)
+    for fd in set([out, err]):
+        os.close(fd)
+    conn.sendall(('%i\n'%pid).encode('ascii'))
+
+    while True:
+        try:
+            _, status, usage = os.wait4(pid, 0)
+            break
+        except OSError as e:
+            if e.errno != errno.EINTR: raise
+    if os.WIFSIGNALED(status):
+        exit_code = -os.WTERMSIG(status)
+    else:
+        exit_code = os.WEXITSTATUS(status)
+
+    # ru_maxrss is in kilobytes on linux but bytes on os x
+    scale = 1 if sys.platform=='darwin' else 1024
+    rusage = dict(utime=usage.ru_utime, stime=usage.ru_stime,
+                  maxrss=usage.ru_maxrss*scale,
+                  nvcsw=usage.ru_nvcsw, nivcsw=usage.ru_nivcsw)
+    conn.sendall((json.dumps(dict(exit_code=exit_code, rusage=rusage))+'\n').encode('ascii'))
+    conn.close()
+
+def run(req, out, err):
+    # become the script: a session of our own (so it can be signalled like a
+    # normal spawn), its cwd and environment, and unbuffered stdio on the fifos
+    os.setsid()
+    null = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(null, 0)
+    os.dup2(out, 1)
+    os.dup2(err, 2)
+    for fd in set([null, out, err]):
+        if fd > 2: os.close(fd)
+
+    native = lambda s: s.encode(sys.getfilesystemencoding()) if str is bytes else s
+    os.chdir(native(req['cwd']))
+    os.environ.clear()
+    for k, v in req['env'].items():
+        os.environ[native(k)] = native(v)
+    _reopen_stdio()
+
+    script = native(req['argv'][0])
+    sys.argv = [native(a) for a in req['argv']]
+    sys.path.insert(0, os.path.dirname(os.path.abspath(script)))
+    exit_code = 0
+    try:
+        runpy.run_path(script, run_name='__main__')
+    except SystemExit as e:
+        exit_code = _exit_code(e)
+    except BaseException:
+        _print_exc()
+        exit_code = 1
+
+    # wait for any (non-daemon) threads the script left running, as the
+    # interpreter would on its way out
+    if 'threading' in sys.modules:
+        try:
+            sys.modules['threading']._shutdown()
+        except BaseException:
+            pass
+    try:
+        atexit._run_exitfuncs()
+    except BaseException:
+        pass
+    for f in (sys.stdout, sys.stderr):
+        try:
+            f.flush()
+        except Exception:
+            pass
+    os._exit(exit_code)
+
+def _reopen_stdio():
+    # the equivalent of python -u
+    if sys.version_info[0] < 3:
+        sys.stdout = sys.__stdout__ = os.fdopen(1, 'w', 0)
+        sys.stderr = sys.__stderr__ = os.fdopen(2, 'w', 0)
+    else:
+        import io
+        enc = os.environ.get('PYTHONIOENCODING') or sys.stdout.encoding or 'utf-8'
+        sys.stdout = sys.__stdout__ = io.TextIOWrapper(io.FileIO(1, 'w', closefd=False),
+                                                       encoding=enc, write_through=True)
+        sys.stderr = sys.__stderr__ = io.TextIOWrapper(io.FileIO(2, 'w', closefd=False), encoding=enc,
+                                                       errors='backslashreplace', write_through=True)
+    sys.stdin = sys.__stdin__ = open(os.devnull)
+
+def _exit_code(e):
+    if e.code is None:
+        return 0
+    if isinstance(e.code, int):
+        return e.code
+    sys.stderr.write('%s\n'%e.code)
+    return 1
+
+def _print_exc():
+    # print the traceback the way the interpreter would, minus our own frames
+    # (and runpy's) so it starts at the script just like a cold run
+    ours = (serve.__code__.co_filename, runpy.run_path.__code__.co_filename)
+    etype, value, tb = sys.exc_info()
+    while tb and tb.tb_frame.f_code.co_filename in ours:
+        tb = tb.tb_next
+    traceback.print_exception(etype, value, tb)
+
+if __name__ == '__main__':
+    serve(sys.argv[1], sys.argv[2:])
@@ -4,18 +4,26 @@ import datetime
 import sublime
 import functools
 import time
+import json
 from collections import defaultdict
 from os.path import relpath, basename
 
 from sublime import Region
 from proc import Task
+from spool import spool_read
+from archive import archive_runs, read_archived
+from index import view_index
+from state import view_state
+from metrics import timed
 
 class Formatter(object):
     # m_begin, m_output, m_result, m_end = list(u"☃☂☔☊")
     m_begin, m_output, m_result, m_end = list(u'\u200b\u200c\u200d\u2060')
-    _err = {} # view ids with errorline info
+    _err = {} # view ids with the regions of their stacktrace's lines
+    _runs = {} # view ids with the offsets of their current run's output
+    _history = {} # view ids with the metadata of each run in 'shebang.runs'
     
-    def begin_run(self, view, pid, inv):
+    def begin_run(self, view, pid, inv, started=None):
         header = []
         if view.size()==0:
             cmd = inv['arg_list']
@@ -24,23 +32,94 @@ class Formatter(object):
 
             header.append(u" cmd: %s\n"%cmd_str)
             header.append(u" dir: %s\n"%inv['working_dir'].replace(os.environ['HOME'],'~'))
-            header.append(u"path: %s\n\n"%inv['env'].get('PATH',os.environ['PATH']))
+            path = inv.get('path') or inv['env'].get('PATH',os.environ['PATH'])
+            header.append(u"path: %s\n\n"%path)
 
         self.fold_prior_output(view)
+        if view.id() not in self._history:
+            self._track_prior_runs(view)
 
         status = inv['arg_list'] if inv.get('shell') else basename(inv['task'].path)
         view.set_name(u'… %s'%status)
 
         timestamp = (u"%s"%datetime.datetime.now()).split('.')[0].replace('-','/')
-        header.append(u"%s%s [%i]%s\n\n"%(self.m_begin,timestamp,pid,self.m_output))
+        start_at = view.size() + len(u"".join(header))
+        header.append(u"%s%s"%(self.m_begin,timestamp))
+        pid_at = view.size() + len(u"".join(header))
+        header.append(u" [%i]%s\n\n"%(pid,self.m_output))
         self.append_txt(view, u"".join(header))
+
+        # remember where this run's pid and output are so finishing it (and
+        # folding it away once the next one starts) doesn't mean searching
+        # through every run in the view
+        pid_str = u" [%i]"%pid
+        view.add_regions('shebang.pid', [Region(pid_at, pid_at+len(pid_str))], 'comment', '', sublime.HIDDEN)
+        self._runs[view.id()] = dict(body=view.size(), marker=0, elided=0, elided_size=0,
+                                     start=start_at, started=started or time.time())
         view.set_status("shebang:running",'Running')
 
+    def show_backlog(self, view, stream):
+        # note in the running status when the output is arriving faster than
+        # the view is taking it
+        run = self._runs.get(view.id())
+        if not run: return
+        status = 'Running'
+        if stream.depth >= stream.size or stream.throttled:
+            action = dict(block="reading paused", spill="spilling to disk", drop="dropping output")
+            status = u"Running · %s queued"%self._pretty('size', stream.depth)
+            if stream.throttled:
+                status += u" (%s)"%action[stream.policy]
+        if run.get('status') != status:
+            run['status'] = status
+            view.set_status("shebang:running", status)
+
+    def _track_prior_runs(self, view):
+        # the runs already in a view (e.g., one restored from a previous
+        # session) aren't being tracked yet, so find them by their headers
+        runs, history = [], []
+        # (the syntax gives the cmd:/dir:/path: lines the same scope as the
+        # headers, so only count the ones that follow a run's begin marker)
+        starts = [r.a-1 for r in view.find_by_selector('comment.header.shebang')
+                  if r.a > 0 and view.substr(Region(r.a-1, r.a)) == self.m_begin]
+        for a, b in zip(starts, starts[1:]+[view.size()]):
+            runs.append(Region(a, b))
+            try:
+                started = time.mktime(time.strptime(view.substr(Region(a+1, a+20)), '%Y/%m/%d %H:%M:%S'))
+            except ValueError:
+                started = None
+            history.append(dict(started=started))
+        view.add_regions('shebang.runs', runs, 'comment', '', sublime.HIDDEN)
+        self._history[view.id()] = history
+
+    def archive_old_runs(self, view, task_id, keep):
+        # move all but the last `keep` runs out of the view and into the archive.
+        # each run is taken to end where the next begins (text appended right
+        # at a region's end may or may not be counted as part of it)
+        runs = view.get_regions('shebang.runs')
+        history = self._history.get(view.id(), [])
+        excess = min(len(runs), len(history)) - max(1, keep)
+        if excess <= 0: return
+
+        spans = [Region(r.a, nxt.a) for r, nxt in zip(runs[:excess], runs[1:])]
+        archive_runs(task_id, [(view.substr(r), meta) for r, meta in zip(spans, history)])
+        view.set_read_only(False)
+        edit = view.begin_edit()
+        view.erase(edit, Region(spans[0].a, spans[-1].b))
+        view.end_edit(edit)
+        view.set_read_only(True)
+        view.add_regions('shebang.runs', view.get_regions('shebang.runs')[excess:], 'comment', '', sublime.HIDDEN)
+        self._history[view.id()] = history[excess:]
+
+    def forget(self, view):
+        self._runs.pop(view.id(), None)
+        self._history.pop(view.id(), None)
+        self._err.pop(view.id(), None)
+
+    @timed('append_txt')
     def append_txt(self, view, txt):
-        # Normalize newlines, Sublime Text always uses a single \n separator
-        # in memory.
-        txt = txt.replace('\r\n', '\n').replace('\r', '\n')
-        
+        # process output arrives with its newlines already normalized by the
+        # OutputStream (Sublime Text always uses a single \n in memory)
+
         # todo: should also only bother scrolling if the new end is beyond 
         # the view bounds
         selection_was_at_end = (len(view.sel()) == 1
@@ -55,6 +134,109 @@ class Formatter(object):
             view.run_command("move_to", {"to": "eof", "extend": False} )
         view.set_read_only(True)
 
+    def trim_run(self, view, max_lines):
+        # keep only the last max_lines lines of the current run's output in the
+        # view (the full text lives in the spool). to avoid editing the view on
+        # every flush, let it grow 10% past the limit before trimming it back
+        run = self._runs.get(view.id())
+        if not run or not max_lines: return
+        start = run['body'] + run['marker']
+        excess = view.rowcol(view.size())[0] - view.rowcol(start)[0] - max_lines
+        if excess <= max_lines//10: return
+
+        cut = view.text_point(view.rowcol(start)[0] + excess, 0)
+        run['elided'] += excess
+        run['elided_size'] += cut - start
+        marker = u"[… %i lines (%s) elided, use Browse Full Output to see them]\n" \
+                    %(run['elided'], self._pretty('size', run['elided_size']))
+
+        view.set_read_only(False)
+        edit = view.begin_edit()
+        view.replace(edit, Region(run['body'], cut), marker)
+        view.end_edit(edit)
+        view.set_read_only(True)
+        run['marker'] = len(marker)
+
+    def display_spool_menu(self, path, name, pages):
+        ui = []
+        for i, (a, b) in enumerate(pages):
+            preview = spool_read(path, a, min(b, a+80)).split(u'\n')[0]
+            ui.append([u"Page %i of %i (%s–%s)"%(i+1, len(pages), self._pretty('size', a), self._pretty('size', b)),
+                       preview])
+
+        def show_page(idx):
+            if idx>=0:
+                view = sublime.active_window().new_file()
+                view.set_scratch(True)
+                view.set_name(u"%s [%i/%i]"%(name, idx+1, len(pages)))
+                view.settings().set('word_wrap', False)
+                edit = view.begin_edit()
+                view.insert(edit, 0, spool_read(path, *pages[idx]))
+                view.end_edit(edit)
+                view.set_read_only(True)
+        sublime.active_window().show_quick_panel(ui, show_page)
+
+    def display_archive_menu(self, entries):
+        ui, titles = [], []
+        for e in entries:
+            name = e['task'][0] if e['task'][1]==-1 else basename(e['task'][0])
+            started = time.strftime('%Y/%m/%d %H:%M:%S', time.localtime(e['started'])) if e.get('started') else u'?'
+            titles.append(u"%s [%s]"%(name, started))
+            if e.get('exit_code') is None:
+                detail = u"(restored from an earlier session)"
+            else:
+                detail = u"%s · %s · exit %s"%(self._pretty('time', e['elapsed']), self._pretty('size', e['size']),
+                                               e['exit_code'])
+            ui.append([u"%s  %s"%(name, started), detail])
+        if not ui:
+            sublime.status_message("No archived runs")
+            return
+
+        def show_run(idx):
+            if idx>=0:
+                self.open_archived(entries[idx], titles[idx])
+        sublime.active_window().show_quick_panel(ui, show_run)
+
+    def open_archived(self, entry, title):
+        view = sublime.active_window().new_file()
+        view.set_scratch(True)
+        view.set_name(title)
+        view.set_syntax_file("Packages/Shebang/Output.tmLanguage")
+        view.settings().set('word_wrap', False)
+        edit = view.begin_edit()
+        view.insert(edit, 0, read_archived(entry))
+        view.end_edit(edit)
+        view.set_read_only(True)
+        return view
+
+    def display_search_results(self, query, results, on_pick):
+        # results are run index entries with a 'preview' line (or None if
+        # the run's output is no longer around)
+        ui = []
+        for r in results:
+            name = r['task'][0] if r['task'][1]==-1 else basename(r['task'][0])
+            started = time.strftime('%Y/%m/%d %H:%M:%S', time.localtime(r['started']))
+            ui.append([u"%s  %s  (exit %s)"%(name, started, r['exit_code']),
+                       (r['preview'] or u"(output no longer available)").strip()[:120]])
+        if not ui:
+            sublime.status_message(u"No runs printed “%s”"%query)
+            return
+
+        def pick(idx):
+            if idx>=0:
+                on_pick(results[idx])
+        sublime.active_window().show_quick_panel(ui, pick)
+
+    def show_line(self, view, pt):
+        # select and scroll to the line at pt (unfolding it if need be)
+        line = view.line(pt)
+        view.unfold(line)
+        view.sel().clear()
+        view.sel().add(line)
+        view.show_at_center(line)
+        if view.window():
+            view.window().focus_view(view)
+
     def _pretty(self, kind, val):
         if kind=='time':
             hrs = val // 3600 
@@ -76,10 +258,31 @@ class Formatter(object):
             frac = ('%1.1f'%val).replace('.0','')
             return '%s %s'%(frac,sfix[0])
             
+    @timed('fold_prior_output')
     def fold_prior_output(self, view):
-        view.fold(view.find_by_selector('output.shebang'))
+        regions = view.get_regions('shebang.output')
+        if not regions and view.size():
+            # the runs in a view restored from a previous session haven't
+            # been tracked, so fall back to letting the syntax find them all
+            regions = view.find_by_selector('output.shebang')
+        view.fold(regions)
+
+    def _clip_pid(self, view):
+        # clip out the pid from the pre-run header. returns the number of
+        # characters removed
+        regions = view.get_regions('shebang.pid')
+        if not regions:
+            regions = [Region(r.a-2, r.b+1) for r in view.find_by_selector('keyword.pid.shebang')]
+        view.erase_regions('shebang.pid')
+        view.set_read_only(False)
+        edit = view.begin_edit()
+        for r in reversed(regions):
+            view.erase(edit, r)
+        view.end_edit(edit)
+        view.set_read_only(True)
+        return sum(r.size() for r in regions)
 
-    def completed_run(self, view, task_id, info, run_body):
+    def completed_run(self, view, task_id, info):
         exit_code = info['exit_code']
         elapsed = info['elapsed']
 
@@ -91,31 +294,41 @@ class Formatter(object):
             errstr = str(exit_code)
 
         # sizestr = self._pretty('size',view.size()-begin.b-3)
-        sizestr = self._pretty('size',len(run_body))
+        sizestr = self._pretty('size',info['size'])
         timestr = self._pretty('time', elapsed)
+        usage = info.get('rusage')
+        if usage:
+            # cpu time, peak memory, and voluntary/involuntary context switches
+            sizestr += u" · cpu %1.2fs+%1.2fs · peak %s · cs %i/%i"%(usage['utime'], usage['stime'],
+                        self._pretty('size', usage['maxrss']), usage['nvcsw'], usage['nivcsw'])
+        footer_at = view.size()
         self.append_txt(view, u'\n%s%s %s %s%s\n'%(self.m_result,timestr,sizestr,errstr, self.m_end))
 
         # update tab label
         status = info['arg_list'] if info.get('shell') else basename(info['task'].path)
         view.set_name(u'%s %s'%(errstr,status))
 
-        # clip out the pid from the pre-run header
-        view.set_read_only(False)
-        edit = view.begin_edit()
-        for r in view.find_by_selector('keyword.pid.shebang'):
-            view.erase(edit, Region(r.a-2, r.b+1))
-        view.end_edit(edit)
-        view.set_read_only(True)
+        clipped = self._clip_pid(view)
+        run = self._runs.get(view.id())
+        if run:
+            # note the output's extent (the same span the syntax scopes as
+            # output.shebang) for fold_prior_output
+            output = Region(run['body']-2-clipped, footer_at+1-clipped)
+            view.add_regions('shebang.output', [output], 'comment', '', sublime.HIDDEN)
+
+            # ...and the whole run's along with how it went for archive_old_runs
+            inv = dict((k, info.get(k)) for k in ('arg_list', 'working_dir', 'shell', 'path', 'encoding'))
+            meta = dict(started=run['started'], invocation=inv)
+            for k in ('exit_code', 'elapsed', 'size', 'lines', 'rusage'):
+                meta[k] = info.get(k)
+            view.add_regions('shebang.runs', view.get_regions('shebang.runs') + [Region(run['start'], view.size())],
+                             'comment', '', sublime.HIDDEN)
+            self._history.setdefault(view.id(), []).append(meta)
         view.erase_status("shebang:running")
 
     def zombie_quit(self, view, task_id, inv):
         self.append_txt(view, u'\n\n%sBroken pipe ⚠%s\n'%(self.m_result, self.m_end))
-        view.set_read_only(False)
-        edit = view.begin_edit()
-        for r in view.find_by_selector('keyword.pid.shebang'):
-            view.erase(edit, Region(r.a-2, r.b+1))
-        view.end_edit(edit)
-        view.set_read_only(True)
+        self._clip_pid(view)
 
         self.fold_prior_output(view)        
         status = inv['arg_list'] if inv.get('shell') else basename(task_id.path)
@@ -123,14 +336,14 @@ class Formatter(object):
         view.erase_status("shebang:running")
 
     def display_stacktrace_panel(self, err_body, inv):
-        try:
-            parent_win = [w for w in sublime.windows() for v in w.views() if v.id()==inv['task'].view][0]
-        except IndexError:
+        src_view = view_index.view(inv['task'].view)
+        if not src_view:
             print "source script no longer open..."
             return
+        parent_win = src_view.window()
 
         # only show the error panel if we're not looking at the output buffer
-        if sublime.active_window().active_view().settings().has('shebang.task_id'):
+        if Task(sublime.active_window().active_view()):
             parent_win.run_command("hide_panel", {"panel": "output.shebang"})
         elif err_body:
             panel = parent_win.get_output_panel("shebang")
@@ -146,6 +359,33 @@ class Formatter(object):
             panel.set_read_only(True)
             parent_win.run_command("show_panel", {"panel": "output.shebang"})
         
+    def display_batch_summary(self, summary):
+        print summary
+        self._show_panel(summary)
+        sublime.status_message(summary.split(u'\n')[0])
+
+    def display_metrics(self, report):
+        self._show_panel(report)
+
+    def display_metrics_dump(self, snapshot):
+        view = sublime.active_window().new_file()
+        view.set_scratch(True)
+        view.set_name(u"Shebang Metrics.json")
+        edit = view.begin_edit()
+        view.insert(edit, 0, json.dumps(snapshot, indent=2, sort_keys=True))
+        view.end_edit(edit)
+
+    def _show_panel(self, txt):
+        win = sublime.active_window()
+        panel = win.get_output_panel("shebang")
+        panel.set_read_only(False)
+        edit = panel.begin_edit()
+        panel.erase(edit, Region(0, panel.size()))
+        panel.insert(edit, 0, txt)
+        panel.end_edit(edit)
+        panel.set_read_only(True)
+        win.run_command("show_panel", {"panel": "output.shebang"})
+
     def display_stacktrace_menu(self, task_id, err):
         file_paths = []
         ui = []
@@ -171,17 +411,21 @@ class Formatter(object):
             else:
                 ui.append("%s: %i"%(rel_pth,frame['line']))
 
+        # the quick panel wants every row to have the same number of lines
+        if any(isinstance(row, list) for row in ui):
+            ui = [row if isinstance(row, list) else [row, u''] for row in ui]
+
         def jump_to_stack_frame(idx):
             if idx>=0:
                 file_path = err['stack'][idx]['path']
                 lineno = err['stack'][idx]['line']
                 parent_win = sublime.active_window()
-                print [w for w in sublime.windows() for v in w.views() if v.id()==task_id.view]
-                for win in (w for w in sublime.windows() for v in w.views() if v.id()==task_id.view):
-                    match = [v for v in win.views() if v.file_name()==file_path]
+                src_view = view_index.view(task_id.view)
+                for win in ([src_view.window()] if src_view else []):
+                    match = [v for v in view_index.file_views([file_path]) if v.window().id()==win.id()]
                     if match:
                         view = match[0]
-                        view.settings().set('shebang.goto',idx)
+                        view_state.set(view, 'shebang.goto', idx)
                         if view.id()==sublime.active_window().active_view().id():
                             self.flash_errors(view)
                         else:
@@ -192,8 +436,8 @@ class Formatter(object):
 
                 view = parent_win.open_file("%s:%i"%(file_path, lineno), sublime.ENCODED_POSITION)
                 stack = [ (f['path']==file_path and f['line']) for f in err['stack']]
-                view.settings().set('shebang.goto', idx)
-                view.settings().set('shebang.stacktrace', {"task":[task_id.path, task_id.view], 
+                view_state.set(view, 'shebang.goto', idx)
+                view_state.set(view, 'shebang.stacktrace', {"task":[task_id.path, task_id.view], 
                                                            "gen":err['gen'],
                                                            "stack":stack, 
                                                            "depth":idx})
@@ -201,16 +445,15 @@ class Formatter(object):
 
     def flash_errors(self, view):
         view.erase_regions('shebang.mark')
-        err = view.settings().get('shebang.stacktrace')
-        goto = view.settings().get('shebang.goto')
+        err = view_state.get(view, 'shebang.stacktrace')
+        goto = view_state.get(view, 'shebang.goto')
         if goto is not None:
-            err['depth'] = goto
-            view.settings().set('shebang.stacktrace', err)
+            err = dict(err, depth=goto)
+            view_state.set(view, 'shebang.stacktrace', err)
             lineno = int(err['stack'][int(err['depth'])])
             if not sublime.load_settings('Shebang.sublime-settings').get('use_separate_window'):
                 view.window().open_file("%s:%i"%(view.file_name(), lineno), sublime.ENCODED_POSITION)
-        all_lines = view.split_by_newlines(Region(0,view.size()))
-        lineno = int(err['stack'][int(err['depth'])])
+        lines, fresh = self._error_lines(view, err)
 
         def blinkenlights(ttl=4):
             if ttl%2:
@@ -219,16 +462,32 @@ class Formatter(object):
                 view.add_regions('shebang.mark', [blinkenlights.errline], 'comment', '', sublime.HIDDEN)    
             if ttl:
                 sublime.set_timeout(functools.partial(blinkenlights,ttl-1), 90)
-        blinkenlights.errline = all_lines[lineno-1]
+        blinkenlights.errline = lines[int(err['depth'])]
         sublime.set_timeout(functools.partial(blinkenlights), 90)
 
-        all_errs = []
-        for line in err['stack']:
-            if line is False: continue
-            all_errs.append(all_lines[int(line-1)])
-        view.add_regions('shebang.errlines', all_errs, 'comment', '../shebang/warning', sublime.HIDDEN)
+        if fresh:
+            all_errs = [r for r in lines if r is not None]
+            view.add_regions('shebang.errlines', all_errs, 'comment', '../shebang/warning', sublime.HIDDEN)
 
         if goto is not None:
             # print "GOTO"
             view.show_at_center(blinkenlights.errline)
-            view.settings().erase('shebang.goto')
+            view_state.erase(view, 'shebang.goto')
+
+    def _error_lines(self, view, err):
+        # the region of each line in the trace (or None for frames in other
+        # files), looked up one at a time rather than by splitting the whole
+        # file. they're reused until the trace or the file changes
+        key = (err.get('gen'), view.change_count())
+        cached = self._err.get(view.id())
+        if cached and cached[0] == key:
+            return cached[1], False
+        lines = [view.line(view.text_point(int(l)-1, 0)) if l is not False else None
+                 for l in err['stack']]
+        self._err[view.id()] = (key, lines)
+        return lines, True
+
+    def clear_errors(self, view):
+        view.erase_regions('shebang.mark')
+        view.erase_regions('shebang.errlines')
+        self._err.pop(view.id(), None)
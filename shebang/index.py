@@ -0,0 +1,88 @@
+# encoding: utf-8
+import sublime
+from collections import defaultdict
+from proc import Task
+
+# keeps track of the open views so lookups by view id, source view, or file
+# path don't have to sweep every view in every window. it's populated once at
+# startup then kept current by the OutputViewWatcher's new/load/clone/close
+# hooks. every hit is checked for still being attached to a window before it's
+# handed back, so a missed event can only ever produce a miss
+class ViewIndex(object):
+    def __init__(self):
+        self.views = {} # view id -> view
+        self.outputs = defaultdict(set) # source view id (from the task id) -> output view ids
+        self.tasks = {} # output view id -> source view id (as of when it was indexed)
+        self.files = defaultdict(set) # file path -> view ids
+        self.paths = {} # view id -> file path (as of when it was indexed)
+
+    def rebuild(self):
+        self.views.clear()
+        self.outputs.clear()
+        self.tasks.clear()
+        self.files.clear()
+        self.paths.clear()
+        for win in sublime.windows():
+            for view in win.views():
+                self.add(view)
+
+    def add(self, view):
+        vid = view.id()
+        self._unfile(vid)
+        self.views[vid] = view
+        if view.file_name():
+            self.files[view.file_name()].add(vid)
+            self.paths[vid] = view.file_name()
+        task_id = Task(view)
+        if task_id:
+            self._link(task_id, vid)
+
+    def add_output(self, task_id, view):
+        self.views[view.id()] = view
+        self._unfile(view.id())
+        self._link(task_id, view.id())
+
+    def remove(self, view):
+        vid = view.id()
+        self.views.pop(vid, None)
+        self._unfile(vid)
+
+    def _link(self, task_id, vid):
+        # (a task can have more than one output view once one's been cloned)
+        self.outputs[task_id.view].add(vid)
+        self.tasks[vid] = task_id.view
+
+    def _unfile(self, vid):
+        path = self.paths.pop(vid, None)
+        if path in self.files:
+            self.files[path].discard(vid)
+            if not self.files[path]:
+                del self.files[path]
+        src = self.tasks.pop(vid, None)
+        if src in self.outputs:
+            self.outputs[src].discard(vid)
+            if not self.outputs[src]:
+                del self.outputs[src]
+
+    def view(self, view_id):
+        view = self.views.get(view_id)
+        if view is not None and view.window() is None:
+            # closed without us hearing about it
+            self.remove(view)
+            return None
+        return view
+
+    def output_view(self, task_id):
+        for vid in sorted(self.outputs.get(task_id.view, ())):
+            view = self.view(vid)
+            if view: return view
+
+    def file_views(self, paths):
+        # all the views (that are still open) of any of the given file paths
+        ids = set()
+        for path in paths:
+            ids.update(self.files.get(path, ()))
+        views = [self.view(vid) for vid in ids]
+        return [v for v in views if v and v.file_name() in paths]
+
+view_index = ViewIndex()
@@ -0,0 +1,110 @@
+# encoding: utf-8
+import time
+import thread
+import functools
+from os.path import basename
+
+# optional instrumentation for the output path. while the `metrics` setting is
+# on, the multiplexer counts each task's bytes, chunks, queued callbacks, and
+# flushes (the first two from the reader thread), and the ui-thread methods
+# wrapped with @timed() keep a running tally of how long they take. while it's
+# off, every hook is a single attribute check
+class Metrics(object):
+    def __init__(self):
+        self.enabled = False
+        self.lock = thread.allocate_lock()
+        self.tasks = {} # task id -> counters for its latest run
+        self.timers = {} # method name -> dict(calls, total, max)
+
+    def begin(self, task_id):
+        with self.lock:
+            self.tasks[task_id] = dict(bytes=0, chunks=0, callbacks=0, flushes=0, ui=0.0,
+                                       start=time.time(), end=None)
+
+    def count(self, task_id, **deltas):
+        with self.lock:
+            counts = self.tasks.get(task_id)
+            if counts is not None:
+                for key, n in deltas.items():
+                    counts[key] += n
+
+    def end(self, task_id):
+        with self.lock:
+            if task_id in self.tasks:
+                self.tasks[task_id]['end'] = time.time()
+
+    def clock(self, name, elapsed, task_id=None):
+        with self.lock:
+            timer = self.timers.setdefault(name, dict(calls=0, total=0.0, max=0.0))
+            timer['calls'] += 1
+            timer['total'] += elapsed
+            timer['max'] = max(timer['max'], elapsed)
+            if task_id in self.tasks:
+                self.tasks[task_id]['ui'] += elapsed
+
+    def reset(self):
+        with self.lock:
+            self.tasks.clear()
+            self.timers.clear()
+
+    def status(self, task_id):
+        # a one-line summary for the status bar of a running task
+        counts = self.tasks.get(task_id)
+        if not counts: return None
+        return u"%1.1f mb in %i chunks · %i flushes (%i queued) · ui %ims" \
+                %(counts['bytes']/1048576.0, counts['chunks'], counts['flushes'],
+                  counts['callbacks'], counts['ui']*1000)
+
+    def snapshot(self):
+        # everything collected so far in a json-friendly form
+        with self.lock:
+            now = time.time()
+            tasks = []
+            for task_id, counts in self.tasks.items():
+                entry = dict(counts, path=task_id.path, view=task_id.view)
+                entry['elapsed'] = (counts['end'] or now) - counts['start']
+                entry['running'] = counts['end'] is None
+                del entry['end']
+                tasks.append(entry)
+            tasks.sort(key=lambda t: t['start'])
+            timers = dict((name, dict(t)) for name, t in self.timers.items())
+            return dict(enabled=self.enabled, tasks=tasks, timers=timers)
+
+    def report(self):
+        # the snapshot as a plain text table
+        snap = self.snapshot()
+        lines = [u"metrics %s"%(u"on" if snap['enabled'] else u"off (set \"metrics\":true to collect)")]
+        if snap['timers']:
+            lines.append(u"")
+            lines.append(u"%-20s %8s %10s %10s %10s"%(u"ui thread", u"calls", u"total ms", u"mean ms", u"max ms"))
+            for name, t in sorted(snap['timers'].items()):
+                lines.append(u"%-20s %8i %10.1f %10.2f %10.2f"%(name, t['calls'], t['total']*1000,
+                             t['total']*1000/t['calls'], t['max']*1000))
+        if snap['tasks']:
+            lines.append(u"")
+            lines.append(u"%-20s %10s %8s %8s %8s %8s %8s"%(u"task", u"kb", u"chunks", u"queued",
+                                                           u"flushes", u"ui ms", u"secs"))
+            for t in snap['tasks']:
+                lines.append(u"%-20s %10.1f %8i %8i %8i %8.1f %8.1f%s"%(basename(t['path'])[:20],
+                             t['bytes']/1024.0, t['chunks'], t['callbacks'], t['flushes'],
+                             t['ui']*1000, t['elapsed'], u" …" if t['running'] else u""))
+        return u"\n".join(lines)
+
+metrics = Metrics()
+
+def timed(name):
+    # wraps a ui-thread method so its calls are clocked while metrics are on.
+    # if the call's first argument is a proc, the time is charged to its task
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(self, *args, **kwargs):
+            if not metrics.enabled:
+                return fn(self, *args, **kwargs)
+            t = time.time()
+            try:
+                return fn(self, *args, **kwargs)
+            finally:
+                task_id = getattr(args[0], 'task', None) if args else None
+                metrics.clock(name, time.time()-t, task_id)
+        return wrapper
+    return decorator
@@ -1,17 +1,25 @@
 # encoding: utf-8
-import os, sys, re
+import os
+import thread
 import functools
 import time
-import json
-import signal
-from collections import defaultdict
-from itertools import izip_longest as izipl
-from os.path import join, exists, basename
+from os.path import exists, basename
 
 import sublime
 from sublime import Region
 from format import Formatter
 from proc import AsyncProcess, Task
+from warm import warm_pool
+from stream import OutputStream
+from spool import Spool, spool_pages
+from trace import TracebackScanner, traceback_parser
+from index import view_index
+from state import view_state
+from sched import Batch
+from metrics import metrics, timed
+from search import RunIndexer, search_index, find_line
+from archive import archived_runs, read_archived
+from registry import run_registry, kill_leftovers
 all_views = lambda: ((w,v) for w in sublime.windows() for v in w.views())
 
 class Multiplexer(object):
@@ -21,73 +29,97 @@ class Multiplexer(object):
     _views = {} # output views
     _procs = {} # running threads
     _stacks = {} # stack traces
+    _batch = None # the batch run in progress (if any)
     
     def __init__(self):
-        def destroy_all_zombies(ttl=20):
-            loaded = [not v.is_loading() for w in sublime.windows() for v in w.views()]
-            if not (loaded and all(loaded)):
-                # keep waiting for the views to load 
-                if ttl: sublime.set_timeout(functools.partial(destroy_all_zombies, ttl-1), 100)
+        # the processes still running when the editor last quit are killed
+        # straight away (the registry knows exactly which they were). their
+        # output views are tidied up as they come in, so nothing has to wait
+        # for the rest of the session's views to finish loading
+        kill_leftovers(run_registry.take())
+        self._reconciled = set() # ids of views that have been checked
+        self._renamed = {} # src task ids from the last session -> their new ones
+        self._strays = {} # ...and the output views of src views not yet seen
+
+        view_index.rebuild()
+        self._reconcile_loaded()
+
+    def _reconcile_loaded(self, ttl=20):
+        # check any views that have finished loading, then keep an eye on the
+        # ones that are still at it (in case their on_load slips past)
+        waiting = False
+        for _,view in all_views():
+            if view.is_loading():
+                waiting = True
             else:
-                renamed = {}
-                for _,view in all_views():
-                    task_id = Task(view)
-                    src_id = json.loads(view.settings().get('shebang.src_id','[]'))
-                    pid = view.settings().get('shebang.task_pid')
-                    if task_id and pid:
-                        # kill any processes that are still running since the last editor launch
-                        print "Zombie process (%i): %s"%(pid, task_id.path)
-                        view.settings().erase('shebang.task_pid')
-                        os.kill(pid, signal.SIGKILL)
-                        task_inv = json.loads(view.settings().get("shebang.invocation", '{}'))
-                        self.formatter.zombie_quit(view, task_id, task_inv)
-                    elif task_id:
-                        # tidy left over output views
-                        self.formatter.fold_prior_output(view)
-                    elif src_id:
-                        # note any src scripts whose view id has changed
-                        src_file, src_view = src_id
-                        if view.id() != src_view:
-                            renamed[Task(src_file, src_view)] = json.dumps([src_file, view.id()])
-                
-                # update the task_id in any output window corresponding to a view-shifted src
-                if renamed:
-                    for _,view in all_views():
-                        task_id = Task(view)
-                        if task_id in renamed:
-                            view.settings().set('shebang.task_id', renamed[task_id])
-
-                # kick off the watchdog process that catches processes whose window got deleted
-                self._watch()            
-        destroy_all_zombies()
-
-    def _watch(self, dt=7000):
-        if self._procs: 
-            out_views = set([v.id() for v in self._views.values()])
-            live_views = set([v.id() for w,v in all_views()])
-            gone_views = out_views.difference(live_views)
-            dt = 1000
-
-            if gone_views:
-                gone_tasks = [task_id for task_id,v in self._views.items() if v.id() in gone_views]
-                for task_id, proc in list(self._procs.items()):
-                    if task_id in gone_tasks:
-                        print "Orphaned process (%i): %s"%(proc.pid, task_id.path)
-                        proc.kill()
-                        del self._procs[task_id]
-                        del self._views[task_id]
-        sublime.set_timeout(functools.partial(self._watch), dt)
+                self._reconcile(view)
+        if waiting and ttl:
+            sublime.set_timeout(functools.partial(self._reconcile_loaded, ttl-1), 250)
+
+    def _reconcile(self, view):
+        if view.id() in self._reconciled: return
+        self._reconciled.add(view.id())
+
+        task_id = Task(view)
+        src_id = view_state.get(view, 'shebang.src_id', [])
+        pid = view_state.get(view, 'shebang.task_pid')
+        if task_id and pid and task_id not in self._procs:
+            # an output view whose process was left running by the last session
+            view_state.erase(view, 'shebang.task_pid')
+            task_inv = view_state.get(view, "shebang.invocation", {})
+            self.formatter.zombie_quit(view, task_id, task_inv)
+        elif task_id and task_id not in self._procs:
+            # tidy left over output views
+            self.formatter.fold_prior_output(view)
+        elif src_id:
+            # note any src scripts whose view id has changed
+            src_file, src_view = src_id
+            if view.id() != src_view:
+                old_id = Task(src_file, src_view)
+                self._renamed[old_id] = [src_file, view.id()]
+                stray = self._strays.pop(old_id, None)
+                if stray: self._adopt(stray, old_id)
+
+        # update the task_id in the output view of a view-shifted src (or wait
+        # for the src to turn up)
+        if task_id and task_id not in self._procs:
+            if task_id in self._renamed:
+                self._adopt(view, task_id)
+            else:
+                self._strays[task_id] = view
+
+    def _adopt(self, view, old_id):
+        if view_index.view(view.id()):
+            view_state.set(view, 'shebang.task_id', self._renamed[old_id])
+            view_index.add(view)
+
+    def _sweep(self):
+        # output views being closed and processes exiting are both handled as
+        # they happen. this is just a rare safety net (which only runs while
+        # something is running) for any close events that slipped past
+        if not self._procs:
+            self._awake = False
+            return
+        for task_id, view in list(self._views.items()):
+            proc = self._procs.get(task_id)
+            if proc and not view_index.view(view.id()):
+                print "Orphaned process (%i): %s"%(proc.pid, task_id.path)
+                proc.kill()
+                run_registry.remove(proc)
+                del self._procs[task_id]
+                del self._views[task_id]
+                self._batch_done(task_id, -1, None)
+        sublime.set_timeout(self._sweep, 30000)
 
     def _setting(self, key):
         return sublime.load_settings('Shebang.sublime-settings').get(key)
 
     def script_win(self, task_id):
-        match = [w for w,v in all_views() if v.id()==task_id.view]
-        if match: return match[0]
+        view = view_index.view(task_id.view)
+        if view: return view.window()
 
     def script_view(self, task_id):
-        match = [v for w,v in all_views() if v.id()==task_id.view]
-        if match: return match[0]
+        return view_index.view(task_id.view)
 
     def output_win(self):
         if self._frame is None or self._frame not in (w.id() for w in sublime.windows()):
@@ -103,16 +135,14 @@ class Multiplexer(object):
     def output_view(self, task_id, create=False):
         old_view = self._views.get(task_id)            
         if old_view:
-            if old_view.id() in [v.id() for w,v in all_views()]:
+            if view_index.view(old_view.id()):
                 return old_view
             del self._views[task_id]
 
-        view_id = task_id.view
-        for view in (v for w,v in all_views() if v.settings().has('shebang.task_id')):
-            this_task = Task(view)
-            if this_task.view == view_id:
-                self._views[task_id] = view
-                return view
+        view = view_index.output_view(task_id)
+        if view:
+            self._views[task_id] = view
+            return view
 
         if create:
             same_window = not self._setting('use_separate_window')
@@ -128,10 +158,19 @@ class Multiplexer(object):
             view.settings().set('word_wrap', False)
             view.settings().set("scroll_past_end", False)
             self._views[task_id] = view
+            view_index.add_output(task_id, view)
             return view
 
+    def view_opened(self, view):
+        view_index.add(view)
+        if not view.is_loading():
+            self._reconcile(view)
+
     def view_closed(self, view):
+        view_index.remove(view)
         task_id = Task(view)            
+        view_state.forget(view)
+        self.formatter.forget(view)
         if task_id and task_id in self._views: 
             del self._views[task_id]
 
@@ -142,7 +181,9 @@ class Multiplexer(object):
         if stale_proc:
             print 'Halted %s'%stale_proc.task.path
             stale_proc.kill()
+            run_registry.remove(stale_proc)
             del self._procs[task_id]
+            self._batch_done(task_id, -1, None)
 
     def spawn_worker(self, task_id, invocation):
         if self._procs.get(task_id):
@@ -150,45 +191,155 @@ class Multiplexer(object):
                 return
 
         invocation['task'] = task_id
-        old_cwd = os.getcwd()
-        old_path = os.environ["PATH"] 
         err_type = WindowsError if os.name=="nt" else OSError
-
         try:
-            if invocation['path']:
-                os.environ["PATH"] = os.path.expandvars(invocation["path"]).encode(sys.getfilesystemencoding())                
-            os.chdir(invocation['working_dir'])
-            proc = AsyncProcess(listener=self, **invocation)
-            view = self.output_view(task_id, create=True)
-            view.settings().set("shebang.invocation", json.dumps(invocation))
-            view.settings().set("shebang.task_id", json.dumps(task_id))
-            view.settings().set("shebang.task_pid", proc.pid)
-            if not invocation.get('shell'):
-                src_settings = self.script_view(task_id).settings()
-                src_settings.set('shebang.src_id', json.dumps(task_id))
-
-            self._procs[task_id] = proc
-            self.formatter.begin_run(view, proc.pid, invocation)
-            print 'Running %s'%task_id.path
+            proc = self._launch(task_id, invocation, self._launch_opts())
+        except err_type as e:
+            self._spawn_failed(invocation, e)
+        else:
+            self._attach(task_id, invocation, proc)
+
+    def spawn_batch(self, jobs):
+        # start a list of (task_id, invocation) pairs in parallel, each from
+        # its own short-lived thread. their output views are hooked up back
+        # on the ui thread as each one comes up. returns the task ids launched
+        opts = self._launch_opts()
+        launched = []
+        for task_id, invocation in jobs:
+            if self._procs.get(task_id):
+                if not self.stop_worker(task_id):
+                    continue
+            invocation['task'] = task_id
+            thread.start_new_thread(self._launch_async, (task_id, invocation, opts))
+            launched.append(task_id)
+        return launched
+
+    def run_batch(self, jobs, limit=None):
+        # queue up a list of (task_id, invocation) pairs and run them no more
+        # than `limit` (by default, the number of cpus) at a time
+        if self.batch_running():
+            sublime.status_message("A batch is already running")
+            return
+        self._batch = Batch(jobs, limit or self._setting('batch_concurrency'))
+        self._batch_step()
+
+    def batch_running(self):
+        return bool(self._batch and not self._batch.finished)
+
+    def cancel_batch(self):
+        if self._batch:
+            self._batch.cancel()
+            self._batch_step()
+
+    def _batch_step(self):
+        batch = self._batch
+        jobs = batch.take()
+        if jobs:
+            launched = self.spawn_batch(jobs)
+            batch.launched(launched)
+            batch.total -= len(jobs) - len(launched)
+        if batch.finished:
+            self._batch = None
+            self.formatter.display_batch_summary(batch.summary())
+        else:
+            sublime.status_message(batch.progress())
+
+    def _batch_done(self, task_id, exit_code, rusage):
+        if self._batch and self._batch.done(task_id, exit_code, rusage):
+            self._batch_step()
 
+    def _launch_async(self, task_id, invocation, opts):
+        err_type = WindowsError if os.name=="nt" else OSError
+        try:
+            proc = self._launch(task_id, invocation, opts)
         except err_type as e:
-            output = []
-            output.append("%s\n"%e.strerror)
-            output.append(" cmd: %s"%(" ".join(invocation['arg_list'])))
-            output.append(' pwd: %s'%os.getcwdu())
-            output.append('path: %s'%(invocation['env'].get('PATH', os.environ['PATH'])))
-            
-            panel = sublime.active_window().get_output_panel("shebang")
-            panel.set_read_only(False)
-            edit = panel.begin_edit()
-            panel.insert(edit, panel.size(), "\n".join(output))
-            panel.show(panel.size())
-            panel.end_edit(edit)
-            panel.set_read_only(True)
-            sublime.active_window().run_command("show_panel", {"panel": "output.shebang"})
-        finally:
-            os.chdir(old_cwd)
-            os.environ['PATH'] = old_path
+            sublime.set_timeout(functools.partial(self._spawn_failed, invocation, e), 0)
+        else:
+            sublime.set_timeout(functools.partial(self._attach, task_id, invocation, proc), 0)
+
+    def _launch_opts(self):
+        # settings are read on the ui thread and handed to _launch from there
+        metrics.enabled = bool(self._setting('metrics'))
+        return dict(flush_interval=self._setting('flush_interval'),
+                    flush_size=self._setting('flush_size'),
+                    max_queued=self._setting('max_queued'),
+                    backpressure=self._setting('backpressure'),
+                    scrollback_lines=self._setting('scrollback_lines'),
+                    separate_stderr=self._setting('separate_stderr'),
+                    pty=self._setting('pty'),
+                    pty_size=self._setting('pty_size'),
+                    index_runs=self._setting('index_runs'),
+                    warm_start=self._setting('warm_start'),
+                    warm_modules=self._setting('warm_modules'))
+
+    def _launch(self, task_id, invocation, opts):
+        # start the process itself. this touches neither the ui nor any
+        # process-wide state (the cwd and PATH are handed to the child
+        # directly) so it's safe to call from any thread
+        spool = Spool(task_id) if opts['scrollback_lines'] else None
+        scanner = None
+        parser = traceback_parser(invocation['arg_list'], task_id.path, invocation.get('file_regex'))
+        if parser:
+            scanner = TracebackScanner(parser, invocation['working_dir'])
+        indexer = RunIndexer() if opts['index_runs'] else None
+        proc_opts = dict(separate_stderr=opts['separate_stderr'], pty=opts['pty'], pty_size=opts['pty_size'])
+        proc_opts.update(invocation)
+        stream = OutputStream(invocation.get('encoding'), opts['flush_interval'], 
+                              opts['flush_size'], spool, scanner, indexer,
+                              opts['max_queued'], opts['backpressure'],
+                              strip_ansi=bool(proc_opts['pty']))
+        if metrics.enabled:
+            metrics.begin(task_id)
+
+        # python scripts can be forked from a server that's already imported
+        # the warm_modules (falling back to a regular spawn until it's up)
+        proc = None
+        if invocation.get('warm_start', opts['warm_start']) and not proc_opts['pty']:
+            proc = warm_pool.spawn(listener=self, stream=stream, modules=opts['warm_modules'], **proc_opts)
+        proc = proc or AsyncProcess(listener=self, stream=stream, **proc_opts)
+        stream.valve = proc
+        return proc
+
+    def _attach(self, task_id, invocation, proc):
+        view = self.output_view(task_id, create=True)
+        view_state.set(view, "shebang.invocation", invocation)
+        view_state.set(view, "shebang.task_id", task_id)
+        view_state.set(view, "shebang.task_pid", proc.pid)
+        if proc.stream.spool:
+            view_state.set(view, "shebang.spool", proc.stream.spool.path)
+        else:
+            view_state.erase(view, "shebang.spool")
+        src_view = self.script_view(task_id)
+        if src_view and not invocation.get('shell'):
+            view_state.set(src_view, 'shebang.src_id', task_id)
+
+        self._procs[task_id] = proc
+        self._stacks.pop(task_id, None) # (the last run's trace no longer applies)
+        run_registry.add(proc)
+        if not self._awake:
+            self._awake = True
+            sublime.set_timeout(self._sweep, 30000)
+        self.formatter.begin_run(view, proc.pid, invocation, proc.start_time)
+        proc.stream.attached = True
+        print 'Running %s'%task_id.path
+
+    def _spawn_failed(self, invocation, e):
+        self._batch_done(invocation['task'], -1, None)
+        output = []
+        output.append("%s\n"%e.strerror)
+        cmd = invocation['arg_list']
+        output.append(" cmd: %s"%(cmd if invocation.get('shell') else " ".join(cmd)))
+        output.append(' pwd: %s'%invocation['working_dir'])
+        output.append('path: %s'%(invocation.get('path') or invocation['env'].get('PATH', os.environ['PATH'])))
+        
+        panel = sublime.active_window().get_output_panel("shebang")
+        panel.set_read_only(False)
+        edit = panel.begin_edit()
+        panel.insert(edit, panel.size(), "\n".join(output))
+        panel.show(panel.size())
+        panel.end_edit(edit)
+        panel.set_read_only(True)
+        sublime.active_window().run_command("show_panel", {"panel": "output.shebang"})
 
     def stop_worker(self, task_id):
         if self._procs.get(task_id):
@@ -201,99 +352,187 @@ class Multiplexer(object):
             if auto_ok or sublime.ok_cancel_dialog('%s:\nKill currently running process?'%name):
                 stale_proc = self._procs[task_id]
                 stale_proc.kill()
+                self._flush(stale_proc) # get the last of its output in before the footer
                 self.finish_worker(stale_proc)
                 return True
             else:
                 return False
 
+    @timed('finish_worker')
     def finish_worker(self, proc):
+        if proc.stream.finished: return
+        proc.stream.finish()
+        run_registry.remove(proc)
+        if metrics.enabled:
+            metrics.end(proc.task)
+
         print 'Complete %s'%proc.task.path
         view = self.output_view(proc.task)
         if not view:
             print "Orphan still writing:",proc.task.path
+            self._batch_done(proc.task, -1, None)
             return
-        view.settings().erase("shebang.task_pid")
+        view_state.erase(view, "shebang.task_pid")
+        view.erase_status("shebang:metrics")
 
-        info = json.loads(view.settings().get("shebang.invocation", '{}'))
+        info = dict(view_state.get(view, "shebang.invocation", {}))
         if info:
-            task_id = info['task'] = Task(*info['task'])
-
-            info.update(dict(exit_code=proc.exit_code(), 
-                             elapsed=time.time() - proc.start_time))
+            # record how the run went alongside the invocation
+            last_run = dict(exit_code=proc.exit_code(), 
+                            elapsed=time.time() - proc.start_time,
+                            size=proc.stream.total,
+                            lines=proc.stream.lines,
+                            rusage=proc.rusage)
+            info['last_run'] = last_run
+            view_state.set(view, "shebang.invocation", info)
 
-            begin = view.find_by_selector('comment.header.shebang')[-1]
-            run_body = view.substr(Region(begin.b+3, view.size()))
-
-            self.formatter.completed_run(view, proc.task, info, run_body)
+            task_id = info['task'] = Task(*info['task'])
+            info.update(last_run)
+            self.formatter.completed_run(view, proc.task, info)
+            keep = self._setting('keep_runs')
+            if keep:
+                self.formatter.archive_old_runs(view, proc.task, keep)
+            if proc.stream.indexer:
+                meta = dict(task=list(proc.task), started=proc.start_time, cmd=info['arg_list'])
+                for k in ('exit_code', 'elapsed', 'size'):
+                    meta[k] = info[k]
+                thread.start_new_thread(search_index.add, (meta, proc.stream.indexer.finish()))
 
             if not info['exit_code']:
                 if task_id in self._stacks:
                     del self._stacks[task_id] 
             else:
-                # examine the output for a recognizable traceback (for now just python...)
-                stack_frames, err_body = self._parse_stacktrace(run_body, info)
-
-                # show the output panel if we're looking at a source view
-                self.formatter.display_stacktrace_panel(err_body, info)
-
-                err_paths = [f['path'] for f in stack_frames]
-                err_gen = "%x"%hash(time.time())
-                self._stacks[task_id] = dict(stack=stack_frames, 
-                                             gen=err_gen, 
-                                             cwd=info['working_dir'] )
-
-                for win, view in ((w,v) for w,v in all_views() if v.file_name() in err_paths):
-                    file_path = view.file_name()
-                    stack = [ (f['path']==file_path and f['line']) for f in stack_frames]
-                    for lineno in reversed(stack):
-                        if lineno is not False:
-                            depth = stack.index(lineno)
-                            view.settings().set('shebang.goto', depth)
-                            break
-                    view.settings().set('shebang.stacktrace', {"task":[task_id.path, task_id.view], 
-                                                               "gen":err_gen,
-                                                               "stack":stack, 
-                                                               "depth":depth})
-                
-                for win in sublime.windows():
-                    if win.active_view().file_name() in err_paths:
-                        self.formatter.flash_errors(win.active_view())
+                # pick up any traceback the scanner didn't get to see the end of
+                # (or else the last one it saw while the process was running)
+                stack_frames, err_body = proc.stream.traceback(final=True)
+                if not stack_frames and task_id in self._stacks:
+                    stack_frames, err_body = self._stacks[task_id]['stack'], self._stacks[task_id]['body']
+                if stack_frames:
+                    self._publish_stacktrace(stack_frames, err_body, info)
 
             if proc.task in self._procs:
                 del self._procs[proc.task]
+            self._batch_done(proc.task, info['exit_code'], proc.rusage)
         else:
             print "...but output window is lost"
+            self._batch_done(proc.task, -1, None)
+
+    def _publish_stacktrace(self, stack_frames, err_body, info, final=True):
+        # a traceback printed while the process is still running is only made
+        # browsable. the panel, the jump to the error, and the flash wait for
+        # the process to exit so a server logging its errors doesn't keep
+        # moving the cursor around
+        task_id = info['task']
+
+        # show the output panel if we're looking at a source view
+        if final:
+            self.formatter.display_stacktrace_panel(err_body, info)
+
+        err_paths = [f['path'] for f in stack_frames]
+        err_gen = "%x"%hash(time.time())
+        self._stacks[task_id] = dict(stack=stack_frames, 
+                                     gen=err_gen, 
+                                     cwd=info['working_dir'],
+                                     body=err_body)
+
+        for view in view_index.file_views(err_paths):
+            file_path = view.file_name()
+            stack = [ (f['path']==file_path and f['line']) for f in stack_frames]
+            for lineno in reversed(stack):
+                if lineno is not False:
+                    depth = stack.index(lineno)
+                    if final:
+                        view_state.set(view, 'shebang.goto', depth)
+                    break
+            view_state.set(view, 'shebang.stacktrace', {"task":[task_id.path, task_id.view], 
+                                                       "gen":err_gen,
+                                                       "stack":stack, 
+                                                       "depth":depth})
+        if not final: return
 
-    def _parse_stacktrace(self, run_body, inv):
-        re_file = re.compile(inv['file_regex'], re.M)
-        m = re_file.search(run_body)
-        if not m: return None, None
-        err_body = run_body[m.start():]
-
-        # at a minimum find the filepaths and linenos for each frame of the trace
-        stack_frames = []
-        for m in re_file.finditer(err_body):
-            fn = m.group(1)
-            file_path = join(inv['working_dir'], fn)
-            if not exists(file_path) and exists(fn):
-                file_path = fn
-            stack_frames.append(dict(start=m.start(), end=m.end(), path=file_path, line=int(m.group(2))))
-
-        # cheat a bit for python and include the echo'd source line for each frame
-        for first, next in izipl(stack_frames, stack_frames[1:]):
-            if next:
-                rng = Region(first['end'], next['start'])
-            else:
-                rng = Region(first['end'], len(err_body))
-
-            m = re.search(r'in ([^\n]*)\n([^\n]+)\n', err_body[rng.a:rng.b], re.S)
-            if m:
-                first['context'] = dict(fn="%s%s"%(m.group(1).strip(), 
-                                           "" if m.group(1).endswith('>') else "()"),
-                                        src=m.group(2).strip() )
-            del first['start']
-            del first['end']
-        return stack_frames, err_body
+        for win in sublime.windows():
+            if win.active_view().file_name() in err_paths:
+                self.formatter.flash_errors(win.active_view())
+
+    def browse_output(self, view):
+        path = view_state.get(view, 'shebang.spool')
+        if path and exists(path):
+            task_id = Task(view)
+            name = task_id.path if task_id.view==-1 else basename(task_id.path)
+            self.formatter.display_spool_menu(path, name, spool_pages(path))
+
+    def has_spool(self, view):
+        return bool(view_state.get(view, 'shebang.spool'))
+
+    def search_history(self, query):
+        # the index lookup and the previews (which can mean unzipping archived
+        # runs) happen off the ui thread. only finding where each run lives
+        # and copying the ones still in a view out of it happens on it
+        def _search():
+            results = search_index.search(query)
+            sublime.set_timeout(functools.partial(_locate, results), 0)
+        def _locate(results):
+            archives = {}
+            for r in results:
+                task_id = Task(*r['task'])
+                if task_id not in archives:
+                    archives[task_id] = archived_runs(task_id)
+                where = self._find_run(task_id, r['started'], archives[task_id])
+                r['txt'] = self.output_view(task_id).substr(where) if isinstance(where, Region) else None
+                r['entry'] = where if isinstance(where, dict) else None
+            thread.start_new_thread(_preview, (results,))
+        def _preview(results):
+            for r in results:
+                txt, entry = r.pop('txt'), r.pop('entry')
+                if entry:
+                    try:
+                        txt = read_archived(entry)
+                    except (IOError, OSError):
+                        txt = None
+                r['preview'] = find_line(txt, query)[1] if txt else None
+            on_pick = functools.partial(self.show_run, query=query)
+            sublime.set_timeout(functools.partial(self.formatter.display_search_results, query, results, on_pick), 0)
+        thread.start_new_thread(_search, ())
+
+    def show_run(self, result, query):
+        # jump to the line matching the query in a run from the search results,
+        # either in its output view or by reopening it from the archive
+        task_id = Task(*result['task'])
+        where = self._find_run(task_id, result['started'])
+        if isinstance(where, Region):
+            txt = self.output_view(task_id).substr(where)
+        else:
+            txt = read_archived(where) if where else None
+        if txt is None:
+            sublime.status_message("That run's output is no longer available")
+            return
+        offset = find_line(txt, query)[0] or 0
+        if isinstance(where, Region):
+            self.formatter.show_line(self.output_view(task_id), where.a + offset)
+        else:
+            started = time.strftime('%Y/%m/%d %H:%M:%S', time.localtime(where['started']))
+            view = self.formatter.open_archived(where, u"%s [%s]"%(basename(task_id.path), started))
+            self.formatter.show_line(view, offset)
+
+    def _find_run(self, task_id, started, entries=None):
+        # where one of a task's runs is: its region in the output view or its
+        # entry in the archive (or None if it's gone). runs are matched by
+        # start time, which is exact for runs from this session but only good
+        # to the second shown in the header for restored ones
+        view = self.output_view(task_id)
+        runs = view.get_regions('shebang.runs') if view else []
+        history = self.formatter._history.get(view.id(), [])[:len(runs)] if view else []
+        entries = archived_runs(task_id) if entries is None else entries
+
+        near = []
+        for src, times in enumerate([[m.get('started') for m in history], [e.get('started') for e in entries]]):
+            near.extend((abs(t - started), src, i) for i, t in enumerate(times) if t and abs(t - started) < 1.5)
+        if not near:
+            return None
+        _, src, i = min(near)
+        if src:
+            return entries[i]
+        return Region(runs[i].a, runs[i+1].a if i+1 < len(runs) else runs[i].b)
 
     def browse_stacktrace(self, task_id):
         stacktrace = self._stacks.get(task_id)
@@ -305,33 +544,88 @@ class Multiplexer(object):
         if task_id:
             return task_id in self._stacks
 
-        trace = view.settings().get('shebang.stacktrace', {})
+        trace = view_state.get(view, 'shebang.stacktrace', {})
         trace_gen = trace.get('gen')
         task_id = Task(*trace.get('task',[None]))
         if trace and task_id in self._stacks:
             if trace_gen == self._stacks[task_id]['gen']:
                 return True
 
-        view.settings().erase('shebang.stacktrace')
-        view.settings().erase('shebang.goto')
-        view.erase_regions('shebang.mark')
-        view.erase_regions('shebang.errlines')
+        if trace:
+            view_state.erase(view, 'shebang.stacktrace')
+            view_state.erase(view, 'shebang.goto')
+        self.formatter.clear_errors(view)
         return False
 
     # event handlers for the async proc running behind the scenes
-    def on_data(self, proc, data):
-        sublime.set_timeout(functools.partial(self._flush, proc, data), 0)
-
-    def _flush(self, proc, data):
+    def on_data(self, proc, data, src='stdout'):
+        # batch up the chunks and only hop over to the ui thread once per
+        # flush_interval (or sooner if flush_size bytes are waiting)
         if data is None:
-            proc.ttl -= 1
-            if not proc.ttl:
+            delay = proc.stream.close(src)
+        else:
+            delay = proc.stream.write(data, src)
+        if metrics.enabled:
+            metrics.count(proc.task, bytes=len(data or ''), chunks=1, callbacks=int(delay is not None))
+        if delay is not None:
+            sublime.set_timeout(functools.partial(self._flush, proc), delay)
+
+    def on_exit(self, proc):
+        if metrics.enabled:
+            metrics.count(proc.task, callbacks=1)
+        sublime.set_timeout(functools.partial(self._exited, proc), 0)
+
+    def _exited(self, proc):
+        if not proc.stream.attached:
+            return sublime.set_timeout(functools.partial(self._exited, proc), 10)
+
+        # if the pipes are still open (e.g., a backgrounded grandchild inherited
+        # them) keep reading until they close before writing the footer
+        if proc.ttl <= 0:
+            self.finish_worker(proc)
+
+    @timed('_flush')
+    def _flush(self, proc):
+        if not proc.stream.attached:
+            # launched from a batch and still waiting on its output view
+            return sublime.set_timeout(functools.partial(self._flush, proc), 10)
+
+        txt, eof = proc.stream.drain()
+        if txt:
+            view = self.output_view(proc.task)
+            self.formatter.append_txt(view, txt)
+            if proc.stream.spool:
+                self.formatter.trim_run(view, self._setting('scrollback_lines'))
+            self.formatter.show_backlog(view, proc.stream)
+        if proc.stream.more:
+            # feed the rest of a spilled backlog in at the usual pace
+            sublime.set_timeout(functools.partial(self._flush, proc), proc.stream.interval)
+        if metrics.enabled:
+            metrics.count(proc.task, flushes=1)
+            if txt: view.set_status("shebang:metrics", metrics.status(proc.task))
+
+        # publish tracebacks as soon as they've been printed rather than waiting
+        # for the process to exit (which a server that logs its errors may never do)
+        stack_frames, err_body = proc.stream.traceback()
+        if stack_frames:
+            info = dict(view_state.get(self.output_view(proc.task), "shebang.invocation", {}))
+            info['task'] = Task(*info['task'])
+            self._publish_stacktrace(stack_frames, err_body, info, final=False)
+
+        if eof:
+            proc.ttl -= eof
+            if proc.ttl <= 0 and proc.exit_code() is not None:
                 self.finish_worker(proc)
-            return 
 
-        try:
-            txt = data.decode(proc.encoding)
-        except:
-            txt = u"[Decode error - output not %s]\n"%proc.encoding
-        view = self.output_view(proc.task)
-        self.formatter.append_txt(view, txt)
+
+# stands in for the Multiplexer so that importing the plugin doesn't do any of
+# the startup work. the real one is created the first time anything asks for
+# it (usually the first view event once the editor's up and running)
+class LazyMultiplexer(object):
+    def __init__(self):
+        self.__dict__['_pool'] = None
+
+    def __getattr__(self, attr):
+        if self._pool is None:
+            self.__dict__['_pool'] = Multiplexer()
+        return getattr(self._pool, attr)
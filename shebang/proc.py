@@ -1,10 +1,18 @@
 # encoding: utf-8
 import os, sys
 import thread
+import threading
 import subprocess
+import select
+import errno
+import functools
 import time
-import json
+import traceback
 from sublime import View
+if os.name != "nt":
+    import pty as ptys
+    import fcntl, termios, struct
+from state import view_state
 from operator import itemgetter
     
 # used as a token to uniquely identify tasks and source view
@@ -14,8 +22,8 @@ class Task(tuple):
             return None
 
         if isinstance(args[0], View):
-            raw_task = args[0].settings().get('shebang.task_id')
-            return tuple.__new__(_cls, json.loads(raw_task)) if raw_task else None
+            task_id = view_state.get(args[0], 'shebang.task_id')
+            return tuple.__new__(_cls, task_id) if task_id else None
         elif len(args)==2:
             return tuple.__new__(_cls, (args[0], int(args[1])))
         elif len(args)==1:
@@ -24,15 +32,222 @@ class Task(tuple):
     view = property(itemgetter(1))
 
 
-# subprocess.Popen with a threaded listener (from Default/exec.py)
+# a single thread that waits on the pipes of every running process at once
+# and forwards whatever it reads (or a None at eof) to the pipe's handler. it
+# also reaps the processes as they exit and only runs while there's something
+# to wait for, so an idle editor has no thread blocked here at all
+class IOLoop(object):
+    def __init__(self):
+        self.lock = thread.allocate_lock()
+        self.handlers = {} # fd -> callback
+        self.paused = set() # fds that aren't being read for now
+        self.children = set() # processes whose exit we're waiting on
+        self.next_reap = 0
+        self.running = False
+        self.dirty = True
+        self.wake_r, self.wake_w = os.pipe()
+
+    def add(self, fd, handler):
+        with self.lock:
+            self.handlers[fd] = handler
+            self.dirty = True
+        self._start()
+
+    def pause(self, fd):
+        # stop reading from fd (leaving its pipe to fill up and block the
+        # writer) until it's resumed
+        with self.lock:
+            self.paused.add(fd)
+            self.dirty = True
+
+    def resume(self, fd):
+        with self.lock:
+            self.paused.discard(fd)
+            self.dirty = True
+        self._wake()
+
+    def watch(self, proc):
+        with self.lock:
+            self.children.add(proc)
+        self._start()
+
+    def _start(self):
+        with self.lock:
+            start, self.running = not self.running, True
+        if start:
+            thread.start_new_thread(self._loop, ())
+        else:
+            self._wake()
+
+    def _wake(self):
+        try:
+            os.write(self.wake_w, 'x')
+        except OSError:
+            pass
+
+    def _wait(self, fds, dirty, timeout):
+        if not hasattr(select, 'poll'):
+            return select.select(fds, [], [], timeout)[0]
+        if dirty or not self.poller:
+            self.poller = select.poll()
+            for fd in fds:
+                self.poller.register(fd, select.POLLIN|select.POLLPRI)
+        ms = None if timeout is None else int(timeout*1000)
+        return [fd for fd,ev in self.poller.poll(ms)]
+
+    def _reap(self):
+        # check on the children every second, or every few ms for the ones
+        # that have closed their pipes and so should be exiting any moment now
+        now = time.time()
+        if now < self.next_reap: return
+        with self.lock:
+            children = list(self.children)
+        exited, failed = [], []
+        for proc in children:
+            try:
+                if proc._reap(): exited.append(proc)
+            except Exception:
+                traceback.print_exc()
+                failed.append(proc)
+        with self.lock:
+            self.children.difference_update(exited + failed)
+            hungup = [p for p in self.children if not p.open_pipes]
+        for proc in exited:
+            try:
+                proc._on_exit()
+            except Exception:
+                traceback.print_exc()
+        self.next_reap = now + (0.02 if hungup else 1.0)
+
+    def _dispatch(self, fd, handler, data):
+        # a handler that fails only costs its own pipe: it's dropped from the
+        # loop (and given its eof so its process can still wind up) rather
+        # than taking down the thread every other task is being read by
+        try:
+            handler(data)
+        except Exception:
+            traceback.print_exc()
+            with self.lock:
+                self.handlers.pop(fd, None)
+                self.paused.discard(fd)
+                self.dirty = True
+            if data is not None:
+                try:
+                    handler(None)
+                except Exception:
+                    traceback.print_exc()
+
+    def _loop(self):
+        self.poller = None
+        try:
+            while self._step():
+                pass
+        except:
+            # let the next add (or watch) start a fresh loop
+            with self.lock:
+                self.running = False
+            raise
+
+    def _step(self):
+        # wait for (and hand off) one round of reads. returns False once
+        # there's nothing left to wait for
+        with self.lock:
+            if not self.handlers and not self.children:
+                self.running = False
+                return False
+            handlers = dict((fd,h) for fd,h in self.handlers.items() if fd not in self.paused)
+            dirty, self.dirty = self.dirty, False
+        timeout = max(0, self.next_reap - time.time()) if self.children else None
+        try:
+            ready = self._wait([self.wake_r] + handlers.keys(), dirty, timeout)
+        except (select.error, OSError, IOError) as e:
+            if e.args[0] == errno.EINTR: return True
+            raise
+
+        for fd in ready:
+            if fd == self.wake_r:
+                os.read(self.wake_r, 512)
+                continue
+            with self.lock:
+                if fd in self.paused or fd not in self.handlers: continue
+            try:
+                data = os.read(fd, 2**15)
+            except OSError as e:
+                if e.errno in (errno.EINTR, errno.EAGAIN): continue
+                data = "" # EIO et al. count as the other end hanging up
+            if data == "":
+                with self.lock:
+                    self.handlers.pop(fd, None)
+                    self.paused.discard(fd)
+                    self.dirty = True
+                    self.next_reap = 0
+                self._dispatch(fd, handlers[fd], None)
+            else:
+                self._dispatch(fd, handlers[fd], data)
+        self._reap()
+        return True
+ioloop = IOLoop()
+
+# fully expanded and encoded child environments, keyed by the build's env
+# overrides and path. an entry is only reused while os.environ still matches
+# the snapshot it was built from, so respawning the same task builds nothing
+class EnvCache(object):
+    max_entries = 32
+
+    def __init__(self):
+        self.lock = thread.allocate_lock()
+        self.envs = {} # (env items, path) -> (os.environ snapshot, child env)
+
+    def get(self, env, path=None):
+        key = (tuple(sorted(env.items())), path)
+        with self.lock:
+            entry = self.envs.get(key)
+            if entry and entry[0] == os.environ:
+                return entry[1]
+
+        base = os.environ.copy()
+        proc_env = dict(base)
+        proc_env.update(env)
+        if path:
+            proc_env['PATH'] = path
+        for k, v in proc_env.iteritems():
+            proc_env[k] = os.path.expandvars(v).encode(sys.getfilesystemencoding())
+
+        with self.lock:
+            if len(self.envs) >= self.max_entries:
+                self.envs.clear()
+            self.envs[key] = (base, proc_env)
+        return proc_env
+env_cache = EnvCache()
+
+def open_pty(size=None):
+    # a pseudo-terminal of size (columns, rows) that doesn't turn \n into \r\n.
+    # returns the fds of its (parent's) master and (child's) slave ends
+    master, slave = ptys.openpty()
+    cols, rows = size or (80, 24)
+    fcntl.ioctl(slave, termios.TIOCSWINSZ, struct.pack('HHHH', rows, cols, 0, 0))
+    attrs = termios.tcgetattr(slave)
+    attrs[1] &= ~termios.ONLCR
+    termios.tcsetattr(slave, termios.TCSANOW, attrs)
+    fcntl.fcntl(master, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+    return master, slave
+
+def _take_terminal():
+    # (in the child) start a new session with the pty as its controlling
+    # terminal, as a shell would
+    os.setsid()
+    fcntl.ioctl(1, termios.TIOCSCTTY, 0)
+
+# subprocess.Popen whose pipes are serviced by the shared ioloop (or by a
+# reader thread per pipe on windows, where select only works with sockets)
 class AsyncProcess(object):
     def __init__(self, arg_list, env, listener,
-                shell=False, encoding=None, task=None, 
-                **kwargs):
-        self.inv = dict((k,v) for k,v in locals().items() if k not in ['self','listener'])
+                shell=False, encoding=None, task=None, stream=None,
+                separate_stderr=False, path=None, working_dir=None, pty=False, pty_size=None, **kwargs):
+        self.inv = dict((k,v) for k,v in locals().items() if k not in ['self','listener','stream'])
         self.listener = listener
+        self.stream = stream
         self.killed = False
-        self.ttl = 1 # 2 (i guess there's nothing to be lost by merging stdout+err?)
         self.encoding = encoding
         self.task = task
         self.start_time = time.time()
@@ -43,57 +258,120 @@ class AsyncProcess(object):
             startupinfo = subprocess.STARTUPINFO()
             startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
 
-        proc_env = os.environ.copy()
-        proc_env.update(env)
-        for k, v in proc_env.iteritems():
-            proc_env[k] = os.path.expandvars(v).encode(sys.getfilesystemencoding())
+        proc_env = env_cache.get(env, path)
 
-        self.proc = subprocess.Popen(arg_list, stdout=subprocess.PIPE,
-            # stderr=subprocess.PIPE, startupinfo=startupinfo, env=proc_env, shell=shell)
-            stderr=subprocess.STDOUT, startupinfo=startupinfo, env=proc_env, shell=shell)
-
-        if self.proc.stdout:
-            thread.start_new_thread(self.read_stdout, ())
-
-        if self.proc.stderr:
-            thread.start_new_thread(self.read_stderr, ())
+        # in pty mode the process's stdout is a terminal (so it line-buffers
+        # like it would in a shell) and we read from the other end of it
+        stdout, master, preexec_fn = subprocess.PIPE, None, None
+        if pty and os.name != "nt":
+            master, stdout = open_pty(pty_size)
+            preexec_fn = _take_terminal
+            if 'TERM' not in proc_env:
+                proc_env = dict(proc_env, TERM='dumb')
 
+        stderr = subprocess.PIPE if separate_stderr else subprocess.STDOUT
+        try:
+            self.proc = subprocess.Popen(arg_list, stdout=stdout, stderr=stderr, 
+                startupinfo=startupinfo, env=proc_env, shell=shell, cwd=working_dir or None,
+                preexec_fn=preexec_fn)
+        except:
+            if master is not None:
+                os.close(master)
+            raise
+        finally:
+            if master is not None:
+                os.close(stdout) # only the child should hold the terminal's end open
         self.pid = self.proc.pid
 
+        # the listener is done with us once every pipe has hit eof and the
+        # process has exited
+        out = os.fdopen(master, 'rb', 0) if master is not None else self.proc.stdout
+        pipes = [p for p in (out, self.proc.stderr) if p]
+        self.ttl = self.open_pipes = len(pipes)
+        self.fds = [p.fileno() for p in pipes]
+        self.flowing = threading.Event() # (the windows reader threads' pause switch)
+        self.flowing.set()
+        self.returncode = None
+        self.rusage = None # cpu time, peak rss, etc. (once it's been reaped)
+        for pipe in pipes:
+            if os.name == "nt":
+                thread.start_new_thread(self._read_pipe, (pipe,))
+            else:
+                ioloop.add(pipe.fileno(), functools.partial(self._on_read, pipe))
+        if os.name != "nt":
+            ioloop.watch(self)
+
     def kill(self):
         if not self.killed:
             self.killed = True
             self.proc.terminate()
             self.listener = None
+            self.resume() # so the pipes get drained and closed
+
+    def pause(self):
+        # stop reading the process's output (and let it block once the pipe
+        # fills) while the listener catches up
+        if os.name == "nt":
+            self.flowing.clear()
+        else:
+            for fd in list(self.fds): ioloop.pause(fd)
+
+    def resume(self):
+        if os.name == "nt":
+            self.flowing.set()
+        else:
+            for fd in list(self.fds): ioloop.resume(fd)
 
     def poll(self):
-        return self.proc.poll() == None
+        return self.returncode == None
 
     def exit_code(self):
-        return self.proc.poll()
+        # only ever set from the thread that reaps the process (so there's no
+        # racing it to waitpid from the ui thread)
+        return self.returncode
 
-    def read_stdout(self):
-        while True:
-            data = os.read(self.proc.stdout.fileno(), 2**15)
+    def _on_read(self, pipe, data):
+        src = 'stderr' if pipe is self.proc.stderr else 'stdout'
+        if data is None:
+            if pipe.fileno() in self.fds: self.fds.remove(pipe.fileno())
+            pipe.close()
+            self.open_pipes -= 1
+        if self.listener:
+            self.listener.on_data(self, data, src)
 
-            if data != "":
-                if self.listener:
-                    self.listener.on_data(self, data)
-            else:
-                self.proc.stdout.close()
-                if self.listener:
-                    self.listener.on_data(self, None)
-                break
+    def _reap(self):
+        # collect the exit status (and resource usage) if the process is done
+        try:
+            pid, status, usage = os.wait4(self.pid, os.WNOHANG)
+        except OSError as e:
+            if e.errno != errno.ECHILD: raise
+            return self.proc.poll() is not None # someone else got to it first
+        if not pid:
+            return False
 
-    def read_stderr(self):
-        while True:
-            data = os.read(self.proc.stderr.fileno(), 2**15)
+        if os.WIFSIGNALED(status):
+            self.proc.returncode = -os.WTERMSIG(status)
+        else:
+            self.proc.returncode = os.WEXITSTATUS(status)
 
-            if data != "":
-                if self.listener:
-                    self.listener.on_data(self, data)
-            else:
-                self.proc.stderr.close()
-                if self.listener:
-                    self.listener.on_data(self, None)
-                break
+        # ru_maxrss is in kilobytes on linux but bytes on os x
+        scale = 1 if sys.platform=='darwin' else 1024
+        self.rusage = dict(utime=usage.ru_utime, stime=usage.ru_stime, 
+                           maxrss=usage.ru_maxrss*scale,
+                           nvcsw=usage.ru_nvcsw, nivcsw=usage.ru_nivcsw)
+        return True
+
+    def _on_exit(self):
+        self.returncode = self.proc.returncode
+        if self.listener:
+            self.listener.on_exit(self)
+
+    def _read_pipe(self, pipe):
+        while True:
+            self.flowing.wait()
+            data = os.read(pipe.fileno(), 2**15)
+            self._on_read(pipe, data if data != "" else None)
+            if data == "": break
+        if not self.open_pipes:
+            self.proc.wait()
+            self._on_exit()
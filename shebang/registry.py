@@ -0,0 +1,110 @@
+# encoding: utf-8
+import os
+import json
+import signal
+import thread
+import subprocess
+from os.path import join, expanduser
+
+REGISTRY_PATH = join(expanduser('~'), '.shebang', 'runs.json')
+HAVE_PROC = os.path.isdir('/proc')
+
+def process_ident(pid):
+    # something that tells this process apart from any later one that ends up
+    # with the same pid: its start time. it comes from /proc where there is
+    # one and from ps otherwise (e.g., on os x). None if neither can say
+    if not HAVE_PROC:
+        return _ps_ident(pid)
+    try:
+        with open('/proc/%i/stat'%pid) as f:
+            stat = f.read()
+    except (IOError, OSError):
+        return None
+    # the command name is in parens and may itself contain spaces or parens
+    fields = stat[stat.rfind(')')+2:].split()
+    return fields[19] if len(fields) > 19 else None
+
+def _ps_ident(pid):
+    if os.name == "nt": return None
+    try:
+        with open(os.devnull, 'r+') as null:
+            ps = subprocess.Popen(['ps', '-o', 'lstart=', '-p', str(pid)], stdin=null,
+                                  stdout=subprocess.PIPE, stderr=null, close_fds=True)
+            started = ps.communicate()[0].strip()
+    except OSError:
+        return None
+    return started or None
+
+# the processes that are running right now, kept on disk so that if the editor
+# quits (or crashes) mid-run, the next launch knows exactly which processes
+# were left behind (their output views are found by their own task_pid
+# settings since view ids don't survive a restart). a run is added when it's
+# attached to its view and removed once it's finished
+class RunRegistry(object):
+    def __init__(self, path=REGISTRY_PATH):
+        self.path = path
+        self.lock = thread.allocate_lock()
+        self.runs = {} # pid -> dict(pid, ident, task, started)
+
+    def add(self, proc):
+        entry = dict(pid=proc.pid, ident=None, task=list(proc.task), started=proc.start_time)
+        with self.lock:
+            self.runs[proc.pid] = entry
+        if HAVE_PROC:
+            self._identify(entry)
+        else:
+            # asking ps takes too long to wait for on the ui thread
+            thread.start_new_thread(self._identify, (entry,))
+
+    def _identify(self, entry):
+        ident = process_ident(entry['pid'])
+        with self.lock:
+            if self.runs.get(entry['pid']) is entry:
+                entry['ident'] = ident
+                self._save()
+
+    def remove(self, proc):
+        with self.lock:
+            if self.runs.pop(proc.pid, None):
+                self._save()
+
+    def take(self):
+        # the runs left over from the last session (clearing them from disk)
+        try:
+            with open(self.path) as f:
+                left = json.load(f)
+        except (IOError, ValueError):
+            return []
+        with self.lock:
+            self._save()
+        return left
+
+    def _save(self):
+        # (called with the lock held)
+        try:
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(self.runs.values(), f)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError) as e:
+            print "Couldn't update the run registry: %s"%e
+
+def still_running(entry):
+    # whether the process an entry describes is still around. without a
+    # start time to check it against, a live pid can't be trusted to be ours
+    ident = entry.get('ident')
+    return ident is not None and process_ident(entry['pid']) == ident
+
+def kill_leftovers(entries):
+    # kill the processes from the last session that are still running
+    for entry in entries:
+        if still_running(entry):
+            print "Zombie process (%i): %s"%(entry['pid'], entry['task'][0])
+            try:
+                os.kill(entry['pid'], signal.SIGKILL)
+            except OSError:
+                pass
+
+run_registry = RunRegistry()
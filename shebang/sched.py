@@ -0,0 +1,62 @@
+# encoding: utf-8
+import os
+import time
+from collections import deque
+from os.path import basename
+
+def cpu_count():
+    try:
+        return max(1, int(os.sysconf('SC_NPROCESSORS_ONLN')))
+    except (AttributeError, ValueError, OSError):
+        return 2
+
+# a queue of (task_id, invocation) jobs that are let out at most `limit` at a
+# time. the multiplexer launches whatever take() hands it and reports back via
+# done() as each one finishes, until the queue and the running set are empty
+class Batch(object):
+    def __init__(self, jobs, limit=None):
+        self.queue = deque(jobs)
+        self.total = len(jobs)
+        self.limit = max(1, limit or cpu_count())
+        self.running = set()
+        self.passed, self.failed = [], []
+        self.cpu = 0.0 # user+sys seconds of the jobs that have finished
+        self.start_time = time.time()
+
+    def take(self):
+        jobs = []
+        while self.queue and len(self.running) + len(jobs) < self.limit:
+            jobs.append(self.queue.popleft())
+        return jobs
+
+    def launched(self, task_ids):
+        self.running.update(task_ids)
+
+    def done(self, task_id, exit_code, rusage=None):
+        if task_id not in self.running: return False
+        self.running.discard(task_id)
+        if rusage:
+            self.cpu += rusage['utime'] + rusage['stime']
+        # (a job that was killed before it could be reaped has no exit code)
+        (self.failed if exit_code != 0 else self.passed).append(task_id)
+        return True
+
+    def cancel(self):
+        self.total -= len(self.queue)
+        self.queue.clear()
+
+    @property
+    def finished(self):
+        return not self.queue and not self.running
+
+    def progress(self):
+        return u"Batch: %i of %i done (%i failed), %i running" \
+                % (len(self.passed)+len(self.failed), self.total, len(self.failed), len(self.running))
+
+    def summary(self):
+        wall = time.time() - self.start_time
+        lines = [u"batch: %i passed, %i failed of %i"%(len(self.passed), len(self.failed), self.total),
+                 u" time: %1.1fs wall, %1.1fs cpu (%1.1fx)"%(wall, self.cpu, self.cpu/wall if wall else 0)]
+        for task_id in self.failed:
+            lines.append(u" fail: %s"%basename(task_id.path))
+        return u"\n".join(lines)
@@ -0,0 +1,163 @@
+# encoding: utf-8
+import os
+import re
+import gzip
+import json
+import thread
+from os.path import join, expanduser
+
+INDEX_DIR = join(expanduser('~'), '.shebang', 'index')
+re_word = re.compile(r'\w{2,32}', re.UNICODE)
+
+def words(txt):
+    return set(re_word.findall(txt.lower()))
+
+# collects the distinct words in a single run's output as it streams in. it's
+# fed from the reader thread (via the OutputStream) so the tokenizing happens
+# off the ui thread, and it only looks at complete lines so words don't get
+# split across chunks
+class RunIndexer(object):
+    max_terms = 50000 # stop collecting after this many distinct words
+    max_partial = 2**16 # ...and don't wait forever for the end of a line
+
+    def __init__(self):
+        self.terms = set()
+        self.partial = u''
+
+    def feed(self, txt, final=False):
+        txt = self.partial + txt
+        cut = len(txt) if final else txt.rfind(u'\n')+1
+        if not cut and len(txt) > self.max_partial:
+            cut = len(txt) - 64
+        self.partial = txt[cut:]
+        if cut and len(self.terms) < self.max_terms:
+            self.terms.update(words(txt[:cut]))
+
+    def finish(self):
+        self.feed(u'', final=True)
+        return self.terms
+
+# an inverted index (word -> ids of the runs whose output contains it) over
+# the output of past runs, each identified by its task and the time it began.
+# it's kept in memory once loaded and saved as a compressed snapshot plus a
+# journal of the runs added since, which gets folded into a new snapshot every
+# so often. ST2's python has no sqlite, hence the hand-rolled format
+class SearchIndex(object):
+    max_runs = 5000 # only the most recent runs are kept
+    max_journal = 64 # runs to add before rewriting the snapshot
+
+    def __init__(self, path=INDEX_DIR):
+        self.path = path
+        self.lock = thread.allocate_lock()
+        self.loaded = False
+        self.runs = {} # run id -> dict(task, started, exit_code, elapsed, size, cmd)
+        self.postings = {} # word -> [run ids]
+        self.next_id = 0
+        self.journaled = 0
+
+    def _load(self):
+        if self.loaded: return
+        self.loaded = True
+        try:
+            f = gzip.open(join(self.path, 'index.json.gz'), 'rb')
+            try:
+                snap = json.loads(f.read())
+            finally:
+                f.close()
+            self.runs = dict((int(k), v) for k, v in snap['runs'].items())
+            self.postings = snap['postings']
+            self.next_id = snap['next_id']
+        except (IOError, ValueError, KeyError):
+            pass
+        try:
+            with open(join(self.path, 'journal')) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue # a half-written last line
+                    self._add(entry['id'], entry['meta'], entry['terms'])
+                    self.journaled += 1
+        except IOError:
+            pass
+
+    def _add(self, run_id, meta, terms):
+        self.runs[run_id] = meta
+        for term in terms:
+            self.postings.setdefault(term, []).append(run_id)
+        self.next_id = max(self.next_id, run_id+1)
+
+    def add(self, meta, terms):
+        # record a finished run. this does disk i/o so call it off the ui thread
+        with self.lock:
+            self._load()
+            run_id, terms = self.next_id, sorted(terms)
+            self._add(run_id, meta, terms)
+            try:
+                if not os.path.isdir(self.path):
+                    os.makedirs(self.path)
+                with open(join(self.path, 'journal'), 'a') as f:
+                    f.write(json.dumps(dict(id=run_id, meta=meta, terms=terms))+'\n')
+                self.journaled += 1
+                if self.journaled > self.max_journal:
+                    self._compact()
+            except (IOError, OSError) as e:
+                print "Couldn't update the run index: %s"%e
+
+    def _compact(self):
+        # drop all but the newest max_runs then replace the snapshot and journal
+        if len(self.runs) > self.max_runs:
+            keep = set(sorted(self.runs)[-self.max_runs:])
+            self.runs = dict((k, v) for k, v in self.runs.items() if k in keep)
+            postings = {}
+            for term, ids in self.postings.items():
+                ids = [i for i in ids if i in keep]
+                if ids: postings[term] = ids
+            self.postings = postings
+
+        tmp_path = join(self.path, 'index.json.gz.tmp')
+        f = gzip.open(tmp_path, 'wb')
+        try:
+            f.write(json.dumps(dict(runs=self.runs, postings=self.postings, next_id=self.next_id)))
+        finally:
+            f.close()
+        os.rename(tmp_path, join(self.path, 'index.json.gz'))
+        os.remove(join(self.path, 'journal'))
+        self.journaled = 0
+
+    def search(self, query, limit=50):
+        # the runs whose output contains every word in the query, newest first
+        terms = words(query)
+        if not terms: return []
+        with self.lock:
+            self._load()
+            hits = [self.postings.get(t) for t in terms]
+            if not all(hits): return []
+            hits.sort(key=len)
+            found = set(hits[0])
+            for ids in hits[1:]:
+                found.intersection_update(ids)
+            found = [dict(self.runs[i], id=i) for i in found if i in self.runs]
+        found.sort(key=lambda r: -r['started'])
+        return found[:limit]
+
+def find_line(txt, query):
+    # the offset and text of the first line of txt containing the query (or
+    # failing that, all of its words)
+    needle = query.strip()
+    found = re.search(re.escape(needle), txt, re.I|re.U) if needle else None
+    pos = found.start() if found else -1
+    if pos < 0:
+        terms = words(query)
+        start = 0
+        for line in txt.split(u'\n'):
+            if terms <= words(line):
+                pos = start
+                break
+            start += len(line)+1
+    if pos < 0: return None, None
+    a = txt.rfind(u'\n', 0, pos)+1
+    b = txt.find(u'\n', pos)
+    return a, txt[a:(len(txt) if b < 0 else b)]
+
+search_index = SearchIndex()
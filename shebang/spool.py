@@ -0,0 +1,79 @@
+# encoding: utf-8
+import os
+import mmap
+import json
+import stat
+import errno
+import tempfile
+from hashlib import md5
+
+SPOOL_DIR = os.path.join(tempfile.gettempdir(), 'shebang-spool-%s'%(os.getuid() if hasattr(os, 'getuid') else 0))
+_fallbacks = {} # shared dirs that weren't safe to use -> our own private ones
+
+def private_dir(path):
+    # a directory under the shared temp dir that only we can read or write
+    # into. if someone else got there first (or loosened its permissions),
+    # a freshly made one is used instead
+    if path in _fallbacks:
+        return _fallbacks[path]
+    try:
+        os.mkdir(path, 0700)
+    except OSError as e:
+        if e.errno != errno.EEXIST: raise
+    if os.name == "nt":
+        return path
+    info = os.lstat(path)
+    if stat.S_ISDIR(info.st_mode) and info.st_uid == os.getuid() and not info.st_mode & 077:
+        return path
+    print "Not using %s (it isn't a private directory of ours)"%path
+    _fallbacks[path] = tempfile.mkdtemp(prefix='%s-'%os.path.basename(path))
+    return _fallbacks[path]
+
+# the complete output of a task's most recent run, written to disk as it
+# streams in so the output view only needs to hold on to the tail end of it
+class Spool(object):
+    def __init__(self, task_id):
+        tag = md5(json.dumps(task_id)).hexdigest()[:12]
+        self.path = os.path.join(private_dir(SPOOL_DIR), '%s.log'%tag)
+
+        # replace the last run's spool rather than writing through whatever
+        # might be sitting at its path
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+        flags = os.O_WRONLY|os.O_CREAT|os.O_EXCL|getattr(os, 'O_NOFOLLOW', 0)|getattr(os, 'O_BINARY', 0)
+        self.file = os.fdopen(os.open(self.path, flags, 0600), 'wb')
+
+    def write(self, txt):
+        self.file.write(txt.encode('utf-8'))
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+# break a spool file into (roughly) page_size-byte chunks that each end on a
+# line boundary, without reading more of the file than the page breaks
+def spool_pages(path, page_size=2**20):
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if not size: return []
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            pages, start = [], 0
+            while start < size:
+                end = mm.find('\n', min(start + page_size, size) - 1)
+                end = size if end < 0 else end + 1
+                pages.append((start, end))
+                start = end
+            return pages
+        finally:
+            mm.close()
+
+def spool_read(path, start, end):
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return mm[start:end].decode('utf-8', 'replace')
+        finally:
+            mm.close()
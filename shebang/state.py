@@ -0,0 +1,49 @@
+# encoding: utf-8
+import json
+
+# the shebang.* view settings, decoded once per view and kept in memory. the
+# ui callbacks that consult them (is_enabled, on_activated, etc.) fire on
+# nearly every keystroke and tab switch, so rather than round-tripping through
+# the settings api and json.loads each time they read from here. every write
+# the package makes goes through set()/erase() which keeps the cache current.
+# values are shared between callers, so copy them before making changes
+class ViewState(object):
+    json_keys = ('shebang.task_id', 'shebang.invocation', 'shebang.src_id')
+    _missing = object()
+
+    def __init__(self):
+        self.cache = {} # view id -> {setting key -> decoded value (or None)}
+
+    def get(self, view, key, default=None):
+        entry = self.cache.setdefault(view.id(), {})
+        val = entry.get(key, self._missing)
+        if val is self._missing:
+            val = entry[key] = self._decode(key, view.settings().get(key))
+        return default if val is None else val
+
+    def set(self, view, key, val):
+        raw = json.dumps(val) if key in self.json_keys else val
+        view.settings().set(key, raw)
+        # cache what a fresh read would produce (e.g., lists rather than tuples
+        # and a dict that the caller won't be holding on to)
+        if isinstance(raw, dict): raw = dict(raw)
+        self.cache.setdefault(view.id(), {})[key] = self._decode(key, raw)
+
+    def erase(self, view, key):
+        view.settings().erase(key)
+        self.cache.setdefault(view.id(), {})[key] = None
+
+    def has(self, view, key):
+        return self.get(view, key) is not None
+
+    def forget(self, view):
+        self.cache.pop(view.id(), None)
+
+    def _decode(self, key, raw):
+        if raw is None: return None
+        if key in self.json_keys:
+            val = json.loads(raw)
+            return tuple(val) if key=='shebang.task_id' else val
+        return raw
+
+view_state = ViewState()
@@ -0,0 +1,236 @@
+# encoding: utf-8
+import thread
+import re
+import codecs
+import tempfile
+from collections import deque
+
+# per-task staging area between the reader thread(s) and the ui thread. chunks
+# accumulate here until either the flush interval elapses or the buffered size
+# crosses the threshold, at which point the whole batch gets inserted at once.
+# the bytes are decoded and their newlines normalized on the way in (i.e., on
+# the reader's thread) so the ui thread only ever sees ready-to-insert unicode.
+#
+# if the ui thread falls behind, what happens once `limit` characters are
+# waiting depends on the policy:
+#   block:  stop reading the process's pipes (the valve) until the next drain,
+#           so the process itself blocks once the pipe fills
+#   spill:  queue the rest in a temp file and feed it to the view a batch at
+#           a time
+#   drop:   keep the oldest and newest of the output and replace what came in
+#           between with a marker (the scanner, indexer, and spool still see
+#           all of it)
+class OutputStream(object):
+    policies = ('block', 'spill', 'drop')
+
+    def __init__(self, encoding='utf-8', interval=50, size=2**16, spool=None, scanner=None, indexer=None,
+                 limit=None, policy='block', strip_ansi=False):
+        try:
+            self.decoder = codecs.getincrementaldecoder(encoding or 'utf-8')
+        except LookupError:
+            print "Unknown encoding (%s), falling back to latin-1"%encoding
+            self.decoder = codecs.getincrementaldecoder('latin-1')
+        self.decoders = {} # one per pipe so interleaved reads don't garble each other
+        self.cr = {} # pipes whose last chunk ended partway through a \r\n
+        self.ansi = {} if strip_ansi else None # per-pipe AnsiFilters (for output from a pty)
+        self.spool = spool # optional on-disk copy of the full output
+        self.total = 0 # bytes read over the life of the process
+        self.lines = 0 # ...and the number of newlines decoded from them
+        self.scanner = scanner # optional TracebackScanner fed with each chunk
+        self.indexer = indexer # optional RunIndexer (fed outside the lock)
+        self.interval = max(0, int(interval or 0))
+        self.size = max(1, int(size or 1))
+        self.lock = thread.allocate_lock()
+        self.chunks = []
+        self.buffered = 0
+        self.limit = max(self.size, int(limit)) if limit else None
+        self.policy = policy if policy in self.policies else 'block'
+        self.valve = None # the process to pause and resume under the block policy
+        self.queued = 0 # characters in chunks
+        self.paused = False
+        self.spill = None # temp file holding the overflow under the spill policy
+        self.spill_pos = self.spill_size = 0 # ...and the unread bytes in it
+        self.spill_decoder = codecs.getincrementaldecoder('utf-8')()
+        self.tail = deque() # the newest output under the drop policy
+        self.tail_size = 0
+        self.dropped = 0 # lines dropped from between chunks and tail
+        self.overflowed = False # whether the policy has kicked in since the last drain
+        self.depth = 0 # characters that were waiting as of the last drain
+        self.throttled = False # ...and whether they'd hit the limit
+        self.more = False # whether the last drain left some of the backlog behind
+        self.eof = 0
+        self.pending = False # a flush has been scheduled
+        self.urgent = False  # ...and it was scheduled to run immediately
+        self.finished = False
+        self.attached = False # whether the listener has a view to put output in yet
+
+    def write(self, data, src='stdout'):
+        # called from the reader thread. returns the delay (in ms) before the
+        # listener should flush, or None if a flush is already on its way
+        txt = self._decode(src, data)
+        if self.indexer and txt:
+            self.indexer.feed(txt)
+        with self.lock:
+            if self.finished: return None
+            if txt: self._append(txt)
+            self.buffered += len(data)
+            self.total += len(data)
+            return self._schedule(self.buffered >= self.size)
+
+    def close(self, src='stdout'):
+        # note the end of one of the process's pipes and ask for a flush right
+        # away so the footer lands promptly after the last of the output
+        txt = self._decode(src, '', final=True)
+        if self.indexer and txt:
+            self.indexer.feed(txt)
+        with self.lock:
+            if self.finished: return None
+            if txt: self._append(txt)
+            self.eof += 1
+            return self._schedule(True)
+
+    def _append(self, txt):
+        self._enqueue(txt)
+        self.lines += txt.count(u'\n')
+        if self.scanner:
+            self.scanner.feed(txt)
+        if self.spool:
+            self.spool.write(txt)
+
+    def _enqueue(self, txt):
+        if self.limit and (self.spill_size or self.tail or self.queued + len(txt) > self.limit):
+            self.overflowed = True
+            if self.policy == 'spill':
+                return self._spill(txt)
+            elif self.policy == 'drop':
+                return self._drop(txt)
+            elif self.valve and not self.paused:
+                self.paused = True
+                self.valve.pause()
+        self.chunks.append(txt)
+        self.queued += len(txt)
+
+    def _spill(self, txt):
+        if not self.spill:
+            self.spill = tempfile.TemporaryFile(prefix='shebang-')
+        data = txt.encode('utf-8')
+        self.spill.seek(0, 2)
+        self.spill.write(data)
+        self.spill_size += len(data)
+
+    def _drop(self, txt):
+        # hold on to the last limit/2 characters
+        self.tail.append(txt)
+        self.tail_size += len(txt)
+        while len(self.tail) > 1 and self.tail_size - len(self.tail[0]) >= self.limit//2:
+            gone = self.tail.popleft()
+            self.tail_size -= len(gone)
+            self.dropped += gone.count(u'\n') or 1
+
+    def _unspill(self):
+        # the next batch's worth of the spill file
+        self.spill.seek(self.spill_pos)
+        data = self.spill.read(min(self.spill_size, self.limit))
+        self.spill_pos += len(data)
+        self.spill_size -= len(data)
+        if not self.spill_size:
+            self.spill.seek(0)
+            self.spill.truncate()
+            self.spill_pos = 0
+        return self.spill_decoder.decode(data)
+
+    def traceback(self, final=False):
+        # returns the frames and text of a traceback that has been completed
+        # since the last call (or Nones). once the process has exited, pass
+        # final=True to also wrap up one that was cut off mid-stream
+        with self.lock:
+            if not self.scanner: return None, None
+            if final: self.scanner.feed(u'', final=True)
+            if not self.scanner.fresh: return None, None
+            self.scanner.fresh = False
+            return self.scanner.traceback()
+
+    def _decode(self, src, data, final=False):
+        if src not in self.decoders:
+            self.decoders[src] = self.decoder(errors='replace')
+        txt = self.decoders[src].decode(data, final)
+        if self.ansi is not None:
+            txt = self.ansi.setdefault(src, AnsiFilter()).feed(txt, final)
+
+        # Sublime Text always uses a single \n separator in memory. hold back a
+        # trailing \r until we know whether the next chunk begins with \n
+        if self.cr.get(src):
+            txt = u'\r' + txt
+        self.cr[src] = not final and txt.endswith(u'\r')
+        if self.cr[src]:
+            txt = txt[:-1]
+        return txt.replace(u'\r\n', u'\n').replace(u'\r', u'\n')
+
+    def _schedule(self, now):
+        if now and not self.urgent:
+            self.pending = self.urgent = True
+            return 0
+        if not self.pending:
+            self.pending = True
+            return self.interval
+
+    def drain(self):
+        # called from the ui thread. hands back everything collected since the
+        # last drain along with the number of pipes that hit eof in the meantime
+        with self.lock:
+            self.depth = self.queued + self.spill_size + self.tail_size
+            self.throttled, self.overflowed = self.overflowed or bool(self.spill_size), False
+            data = u"".join(self.chunks)
+            if self.spill_size:
+                data += self._unspill()
+            if self.tail:
+                if self.dropped:
+                    nl = u'' if not data or data.endswith(u'\n') else u'\n'
+                    data += u"%s[… %i lines dropped while the output caught up]\n"%(nl, self.dropped)
+                data += u"".join(self.tail)
+                self.tail.clear()
+                self.tail_size = self.dropped = 0
+            if self.paused:
+                self.paused = False
+                self.valve.resume()
+
+            # hold back the eofs until the last of the spill file is drained
+            self.more = bool(self.spill_size)
+            eof = 0 if self.more else self.eof
+            self.chunks, self.queued, self.buffered, self.eof = [], 0, 0, self.eof - eof
+            self.pending = self.urgent = self.more
+            return data, eof
+
+    def finish(self):
+        # stop accepting output once the footer has been written
+        with self.lock:
+            self.finished = True
+            self.chunks, self.buffered, self.queued = [], 0, 0
+            if self.spill:
+                self.spill.close()
+                self.spill, self.spill_size = None, 0
+            if self.paused:
+                self.paused = False
+                self.valve.resume()
+            if self.spool:
+                self.spool.close()
+
+# removes the terminal control sequences (colors, cursor movement, titles,
+# etc.) that programs emit when they find themselves running in a pty. a
+# sequence split across chunks is held back until the rest of it arrives
+class AnsiFilter(object):
+    re_seq = re.compile(r'\x1b(?:\[[0-?]*[ -/]*[@-~]|\][^\x07\x1b]*(?:\x07|\x1b\\)|[()*+][0-9A-Za-z]|[@-Z\\^_=>78])'
+                        r'|[\x07\x0e\x0f]')
+    max_partial = 512 # give up waiting on an unterminated sequence after this
+
+    def __init__(self):
+        self.partial = u''
+
+    def feed(self, txt, final=False):
+        txt, self.partial = self.partial + txt, u''
+        esc = txt.rfind(u'\x1b')
+        if esc >= 0 and not final and len(txt) - esc < self.max_partial:
+            m = self.re_seq.match(txt, esc)
+            if not m:
+                txt, self.partial = txt[:esc], txt[esc:]
+        return self.re_seq.sub(u'', txt)
@@ -0,0 +1,230 @@
+# encoding: utf-8
+import re
+import shlex
+from os.path import join, exists, basename, splitext
+
+# how to pick the stack frames out of a particular runtime's error output. the
+# frame pattern captures each frame's path and line (and, where the runtime
+# prints one, the function) in a single match, and everything else about the
+# format is declared here so the scanner itself stays runtime-agnostic:
+#
+#   src:          the line after each frame is its source (python-style)
+#   fn_line:      the function name is on the line before the frame instead
+#   preamble:     a line that introduces a traceback (kept with its text)
+#   end:          a line that ends the traceback (kept with its text)
+#   gap:          how many other lines can come between frames before the
+#                 traceback is considered over
+#   newest_first: the runtime prints the innermost frame first. frames are
+#                 always reported outermost first (as python does)
+#   skip:         frames whose path matches are left out (runtime internals)
+#
+# file_regex is the equivalent Sublime result_file_regex for the output panel
+class TracebackParser(object):
+    def __init__(self, name, frame, file_regex, src=False, fn_line=None, preamble=None,
+                 end=None, gap=0, newest_first=False, skip=None, fn_format=None):
+        self.name = name
+        self.frame = re.compile(frame)
+        self.file_regex = file_regex
+        self.src = src
+        self.fn_line = re.compile(fn_line) if fn_line else None
+        self.preamble = re.compile(preamble) if preamble else None
+        self.end = re.compile(end) if end else None
+        self.gap = gap
+        self.newest_first = newest_first
+        self.skip = re.compile(skip) if skip else None
+        self.fn_format = fn_format or (lambda fn: fn)
+
+    def match(self, line):
+        # the path, line number, and function (or None) of a frame line
+        m = self.frame.search(line)
+        if not m: return None
+        groups = m.groupdict()
+        path = groups.get('path') or (m.group(1) if self.frame.groups > 0 else None)
+        lineno = groups.get('line') or (m.group(2) if self.frame.groups > 1 else None)
+        if not (path and lineno) or (self.skip and self.skip.search(path)):
+            return False
+        return path, int(lineno), groups.get('fn')
+
+    def function(self, line):
+        m = self.fn_line.search(line) if self.fn_line else None
+        return m.group('fn') if m else None
+
+_python_fn = lambda fn: "%s%s"%(fn.strip(), "" if fn.endswith('>') else "()")
+
+PARSERS = dict((p.name, p) for p in [
+    TracebackParser('python',
+        r'^\s*File "(?P<path>[^"]+)", line (?P<line>\d+)(?:, in (?P<fn>.*))?',
+        "^[ ]*File \"(...*?)\", line ([0-9]*)",
+        src=True, preamble=r'^Traceback', end=r'^\S', gap=2, fn_format=_python_fn),
+    TracebackParser('pytest',
+        r'^(?P<path>[^\s:][^:]*\.py):(?P<line>\d+):(?: in (?P<fn>\S+)| \w+|\s*$)',
+        "^([^ :][^:]*\\.py):([0-9]+): ",
+        end=r'^(?:={3,}|_{3,}) ', gap=200),
+    TracebackParser('node',
+        r'^\s+at (?:(?P<fn>.+?) \()?(?P<path>[^()\s]+?):(?P<line>\d+):(?P<col>\d+)\)?$',
+        "^\\s+at (?:.+? \\()?([^()\\s]+?):([0-9]+):([0-9]+)",
+        preamble=r'^\S', newest_first=True, skip=r'^(?:node:|internal/)'),
+    TracebackParser('ruby',
+        r'^(?:\s+from )?(?P<path>[^\s:][^:]*?):(?P<line>\d+):in [`\'](?P<fn>[^`\']*)\'',
+        "^(?:\\s+from )?([^ :][^:]*?):([0-9]+):in ",
+        newest_first=True, skip=r'^<internal:'),
+    TracebackParser('go',
+        r'^\t(?P<path>\S+\.go):(?P<line>\d+)(?: \+0x[0-9a-f]+)?$',
+        "^\\t(\\S+\\.go):([0-9]+)",
+        fn_line=r'^(?P<fn>\S.*)$', gap=1, newest_first=True),
+    TracebackParser('rust',
+        r'(?:^\s+at |panicked at (?:\'.*\', )?)(?P<path>[^\s:\']+):(?P<line>\d+):\d+:?$',
+        "^\\s+at ([^\\s:]+):([0-9]+):([0-9]+)",
+        fn_line=r'^\s+\d+: (?P<fn>.+)$', preamble=r'^stack backtrace:', gap=4,
+        newest_first=True, skip=r'^/rustc/'),
+    TracebackParser('perl',
+        r'(?:^\s+(?P<fn>\S+\(.*\)) called)? at (?P<path>\S+) line (?P<line>\d+)\.?',
+        " at (\\S+) line ([0-9]+)",
+        newest_first=True),
+])
+
+# the runtimes' interpreters (or build tools) and script extensions
+_interpreters = [('pytest', 'pytest'), ('py.test', 'pytest'), ('python', 'python'),
+                 ('node', 'node'), ('nodejs', 'node'), ('deno', 'node'), ('bun', 'node'),
+                 ('ruby', 'ruby'), ('go', 'go'), ('cargo', 'rust'), ('rustc', 'rust'),
+                 ('perl', 'perl')]
+_extensions = {'.py':'python', '.js':'node', '.mjs':'node', '.ts':'node', '.rb':'ruby',
+               '.go':'go', '.rs':'rust', '.pl':'perl', '.pm':'perl', '.t':'perl'}
+_wrappers = set(['env', 'sudo', 'nice', 'nohup', 'time', 'exec'])
+_custom = {} # file_regex -> a parser built from it
+
+def traceback_parser(cmd, file_path=None, file_regex=None):
+    # the parser for a build's file_regex (if it has one) or else for the
+    # runtime its command line (or failing that, the script's name) points to
+    if file_regex:
+        for parser in PARSERS.values():
+            if parser.file_regex == file_regex:
+                return parser
+        if file_regex not in _custom:
+            # a build's regex usually picks out compiler-style errors with
+            # their context in between, so every match to the end is kept
+            _custom[file_regex] = TracebackParser('custom', file_regex, file_regex, gap=200)
+        return _custom[file_regex]
+
+    args = cmd
+    if not isinstance(cmd, (list, tuple)):
+        try:
+            args = shlex.split((cmd or '').encode('utf-8'))
+        except ValueError:
+            args = (cmd or '').split()
+    # only the interpreter (found past any wrappers like env) and its options
+    # count, not the script or the script's arguments
+    names = [basename(a) for a in args]
+    at = 0
+    while at < len(names)-1 and (names[at].startswith('-') or '=' in names[at] or names[at] in _wrappers):
+        at += 1
+    for i, opt in enumerate(names[at+1:]):
+        if opt == '-m':
+            if names[at+i+2:at+i+3] == ['pytest']:
+                return PARSERS['pytest']
+            break
+        if not opt.startswith('-'): break
+    for name in names[at:at+1]:
+        for prefix, runtime in _interpreters:
+            if name == prefix or (name.startswith(prefix) and name[len(prefix):][:1] in '0123456789.-'):
+                return PARSERS[runtime]
+    runtime = _extensions.get(splitext(file_path or '')[1].lower())
+    return PARSERS[runtime] if runtime else None
+
+# watches the output stream line by line for the stack frames its parser
+# recognizes. frames are collected as they arrive so the stack is ready to
+# browse as soon as the process exits (or, for long-running processes that log
+# an exception and carry on, as soon as the traceback is complete)
+class TracebackScanner(object):
+    max_trailer = 50 # lines of output to keep after the end of a traceback
+    max_partial = 2**12 # ...and characters of any one line
+
+    def __init__(self, parser, cwd):
+        self.parser = parser
+        self.cwd = cwd
+        self.partial = u''
+        self.prev = u''
+        self.active = False # whether a traceback is being read
+        self.frames = [] # frames of the traceback currently being read
+        self.body = [] # ...and the lines of output they came from
+        self.gap = 0 # lines since the last frame
+        self.trailer = 0 # lines appended to body since the traceback ended
+        self.context = None # the frame whose source line comes next
+        self.latest = None # most recent complete traceback as (frames, body)
+        self.fresh = False # whether latest has been seen by the listener yet
+
+    def feed(self, txt, final=False):
+        # only the new text is split, and no line is kept past max_partial
+        # (frame lines are never that long) so a run that prints megabytes
+        # without a newline costs no more than one that doesn't
+        cap = self.max_partial
+        if not final and u'\n' not in txt:
+            if len(self.partial) < cap:
+                self.partial += txt[:cap-len(self.partial)]
+            return
+        lines = txt.split(u'\n')
+        lines[0] = self.partial + lines[0][:max(0, cap-len(self.partial))]
+        lines = [line[:cap] for line in lines]
+        self.partial = lines.pop()
+        if final and self.partial:
+            lines.append(self.partial)
+            self.partial = u''
+        for line in lines:
+            self._scan(line)
+        if final and self.active and not self.trailer:
+            self._complete()
+
+    def _scan(self, line):
+        parser = self.parser
+        found = parser.match(line)
+        if found is not None:
+            if not self.active or self.trailer:
+                # the start of a new traceback (along with its preamble)
+                self.active, self.frames, self.trailer = True, [], 0
+                preamble = parser.preamble and parser.preamble.search(self.prev)
+                self.body = [self.prev] if preamble else []
+            self.body.append(line)
+            self.gap = 0
+            self.context = None
+            if found:
+                frame = self._frame(*found)
+                self.frames.append(frame)
+                self.context = frame if parser.src and 'context' in frame else None
+        elif self.active and not self.trailer:
+            self.body.append(line)
+            if self.context:
+                self.context['context']['src'] = line.strip()
+                self.context = None
+            elif (parser.end and parser.end.search(line)) or self.gap >= parser.gap:
+                # anything else (e.g., the exception message) ends the traceback
+                self._complete()
+            else:
+                self.gap += 1
+        elif self.active and self.trailer < self.max_trailer:
+            self.body.append(line)
+            self.trailer += 1
+        self.prev = line
+
+    def _frame(self, fn, lineno, func):
+        file_path = join(self.cwd, fn)
+        if not exists(file_path) and exists(fn):
+            file_path = fn
+        frame = dict(path=file_path, line=lineno)
+        func = func or self.parser.function(self.prev)
+        if func:
+            frame['context'] = dict(fn=self.parser.fn_format(func), src=u'')
+        return frame
+
+    def _complete(self):
+        frames = self.frames[::-1] if self.parser.newest_first else self.frames
+        self.latest = (frames, self.body)
+        self.trailer = max(self.trailer, 1)
+        self.context = None
+        self.fresh = True
+
+    def traceback(self):
+        # the latest traceback's frames and its text as it appeared in the output
+        if self.latest:
+            frames, body = self.latest
+            return frames, u'\n'.join(body)
+        return None, None
@@ -0,0 +1,68 @@
+# encoding: utf-8
+import os
+import time
+from os.path import dirname, exists
+
+# remembers where (or whether) a virtualenv was found for a given script dir
+# and search pattern so reruns don't have to stat every ancestor directory.
+# an entry is thrown out once it's older than the ttl, or sooner if the
+# script's directory has been modified or the interpreter it found has vanished
+class VirtualenvCache(object):
+    def __init__(self):
+        self.entries = {} # (dir, pattern) -> dict(path, mtime, stamp)
+
+    def resolve(self, file_path, ve_pattern, ttl=300):
+        ve_binary = os.path.join(ve_pattern,'bin','python')
+        rooted = ve_binary[0] in '~/'
+        key = (None if rooted else dirname(file_path), ve_pattern)
+        mtime = self._mtime(key[0])
+
+        entry = self.entries.get(key)
+        if entry and time.time()-entry['stamp'] < ttl and entry['mtime']==mtime:
+            if entry['path'] is None or exists(entry['path']):
+                return entry['path']
+
+        ve_pth = None
+        if rooted:
+            # try using the virtualenv config string as an absolute path...
+            ve_pth = ve_binary.replace('~',os.environ.get('HOME','~'))
+            if not exists(ve_pth):
+                ve_pth = None
+        else:
+            # ...otherwise keep stepping up from the file_path's dir looking
+            # for a folder with a name matching the config string
+            for pth in parents(file_path, ve_binary):
+                if exists(pth):
+                    ve_pth = pth
+                    break
+
+        self.entries[key] = dict(path=ve_pth, mtime=mtime, stamp=time.time())
+        return ve_pth
+
+    def _mtime(self, dir_path):
+        try:
+            return os.stat(dir_path).st_mtime if dir_path else None
+        except OSError:
+            return None
+
+    def items(self):
+        return sorted(self.entries.items(), key=lambda item: -item[1]['stamp'])
+
+    def discard(self, key):
+        self.entries.pop(key, None)
+
+    def flush(self):
+        self.entries.clear()
+
+def parents(file_path, sub_path=None):
+    dirs = []
+    parent_dir = dirname(file_path)
+    while True:
+        if sub_path: dirs.append(os.path.join(parent_dir, sub_path))
+        else: dirs.append(parent_dir)
+        new_dir = dirname(parent_dir)
+        if parent_dir == new_dir: break
+        parent_dir = new_dir
+    return dirs
+
+venv_cache = VirtualenvCache()
@@ -0,0 +1,204 @@
+# encoding: utf-8
+import os, sys
+import json
+import time
+import signal
+import socket
+import thread
+import shutil
+import tempfile
+import functools
+import subprocess
+from hashlib import md5
+from os.path import join, dirname, basename, isabs
+from proc import ioloop, env_cache
+from spool import private_dir
+if os.name != "nt":
+    import fcntl
+
+SERVER_SCRIPT = join(dirname(os.path.abspath(__file__)), 'forkserver.py')
+
+# a run forked from a warm server. as far as the Multiplexer can tell it's an
+# AsyncProcess: the child's stdout (and stderr) come through the ioloop from
+# fifos it was attached to, and its exit status and rusage arrive over the
+# control socket once the server has reaped it
+class WarmProcess(object):
+    connect_timeout = 5
+
+    def __init__(self, sock_path, argv, env, listener, encoding=None, task=None,
+                 stream=None, separate_stderr=False, working_dir=None, **kwargs):
+        self.listener = listener
+        self.stream = stream
+        self.killed = False
+        self.encoding = encoding
+        self.task = task
+        self.start_time = time.time()
+        self.returncode = None
+        self.rusage = None
+        self.trailer = ''
+
+        # the fifos only need to exist until both ends have been opened
+        fifo_dir = tempfile.mkdtemp(prefix='shebang-')
+        srcs = ['stdout', 'stderr'] if separate_stderr else ['stdout']
+        try:
+            fifos = {}
+            for src in srcs:
+                fifos[src] = join(fifo_dir, src)
+                os.mkfifo(fifos[src], 0600)
+            fds = dict((src, os.open(path, os.O_RDONLY|os.O_NONBLOCK)) for src, path in fifos.items())
+            try:
+                self.conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self.conn.settimeout(self.connect_timeout)
+                self.conn.connect(sock_path)
+                req = dict(argv=argv, cwd=working_dir or os.getcwd(), env=env,
+                           out=fifos['stdout'], err=fifos.get('stderr'))
+                self.conn.sendall(json.dumps(req)+'\n')
+                self.pid = int(self._read_line())
+            except:
+                for fd in fds.values():
+                    os.close(fd)
+                raise
+        finally:
+            shutil.rmtree(fifo_dir, ignore_errors=True)
+
+        # the writing ends are open by now so the reads can block (in the
+        # ioloop) like any other pipe's
+        self.ttl = self.open_pipes = len(fds)
+        self.fds = fds.values()
+        for src, fd in fds.items():
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) & ~os.O_NONBLOCK)
+            ioloop.add(fd, functools.partial(self._on_read, fd, src))
+        self.conn.settimeout(None)
+        ioloop.add(self.conn.fileno(), self._on_status)
+
+    def _read_line(self):
+        line = ''
+        while not line.endswith('\n'):
+            data = self.conn.recv(64)
+            if not data: raise socket.error("warm server hung up")
+            line += data
+        return line
+
+    def kill(self):
+        if not self.killed:
+            self.killed = True
+            try:
+                os.kill(self.pid, signal.SIGTERM)
+            except OSError:
+                pass
+            self.listener = None
+            self.resume()
+
+    def pause(self):
+        for fd in list(self.fds): ioloop.pause(fd)
+
+    def resume(self):
+        for fd in list(self.fds): ioloop.resume(fd)
+
+    def poll(self):
+        return self.returncode == None
+
+    def exit_code(self):
+        return self.returncode
+
+    def _on_read(self, fd, src, data):
+        if data is None:
+            if fd in self.fds: self.fds.remove(fd)
+            os.close(fd)
+            self.open_pipes -= 1
+        if self.listener:
+            self.listener.on_data(self, data, src)
+
+    def _on_status(self, data):
+        if data is not None:
+            self.trailer += data
+            return
+
+        self.conn.close()
+        try:
+            status = json.loads(self.trailer)
+            self.returncode, self.rusage = status['exit_code'], status['rusage']
+        except (ValueError, KeyError):
+            self.returncode = -signal.SIGKILL # the server's waiter died along with it
+        if self.listener:
+            self.listener.on_exit(self)
+
+# the warm servers, one per interpreter, preloaded module list, and
+# environment. a server is started the first time a script would use it and
+# that run (and any others until it's ready) spawns cold as usual. they exit
+# on their own once the editor does
+class WarmPool(object):
+    retry_after = 60 # seconds to wait before restarting a server that died
+
+    def __init__(self):
+        self.lock = thread.allocate_lock()
+        self.servers = {} # key -> dict(proc, sock_path, started)
+
+    def spawn(self, arg_list, env, listener, modules=(), shell=False, path=None,
+              working_dir=None, **kwargs):
+        # fork the run from a warm server if it's a plain `python -u script`
+        # invocation and a server is ready for it. otherwise returns None
+        if shell or os.name=="nt": return None
+        proc_env = env_cache.get(env, path)
+        target = self._target(arg_list, proc_env, working_dir)
+        if not target: return None
+        python, argv = target
+
+        sock_path = self._server(python, modules, proc_env)
+        if not sock_path: return None
+        fs_enc = sys.getfilesystemencoding()
+        env = dict((k.decode(fs_enc, 'replace'), v.decode(fs_enc, 'replace')) for k, v in proc_env.items())
+        try:
+            return WarmProcess(sock_path, argv, env, listener, working_dir=working_dir, **kwargs)
+        except (socket.error, OSError, ValueError) as e:
+            print "Warm start failed (%s), spawning %s cold"%(e, argv[0])
+            return None
+
+    def _target(self, arg_list, env, working_dir):
+        # the interpreter and argv for invocations of the form that
+        # script_invocation builds: [/usr/bin/env] python -u script [args]
+        if not isinstance(arg_list, (list, tuple)): return None
+        args = list(arg_list)
+        if args and args[0] == '/usr/bin/env':
+            args = args[1:]
+        if len(args) < 3 or args[1] != '-u' or not basename(args[0]).startswith('python'):
+            return None
+
+        python = args[0]
+        if os.sep not in python:
+            found = [join(d, python) for d in env.get('PATH', '').split(os.pathsep)]
+            found = [p for p in found if os.access(p, os.X_OK)]
+            if not found: return None
+            python = found[0]
+        elif not isabs(python):
+            python = join(working_dir or os.getcwd(), python)
+        return os.path.normpath(python), args[2:]
+
+    def _server(self, python, modules, env):
+        # the socket path of a server that's ready to take runs (or None if
+        # it's still starting up, in which case it gets started)
+        modules = list(modules or [])
+        key = md5(repr((python, modules, sorted(env.items())))).hexdigest()[:12]
+        with self.lock:
+            server = self.servers.get(key)
+            if server and server['proc'] and server['proc'].poll() is None:
+                return server['sock_path'] if os.path.exists(server['sock_path']) else None
+            if server and time.time() - server['started'] < self.retry_after:
+                return None
+
+            try:
+                # (the sockets live in a directory only we can get into)
+                sock_dir = private_dir(join(tempfile.gettempdir(), 'shebang-%i'%os.getuid()))
+                sock_path = join(sock_dir, '%s.sock'%key)
+                if os.path.exists(sock_path):
+                    os.remove(sock_path) # left over from a server that's gone
+                with open(os.devnull, 'r+') as null:
+                    proc = subprocess.Popen([python, SERVER_SCRIPT, sock_path] + modules,
+                                            stdin=null, stdout=null, env=env, close_fds=True)
+            except (IOError, OSError) as e:
+                print "Couldn't start a warm server for %s: %s"%(python, e)
+                proc, sock_path = None, None
+            self.servers[key] = dict(proc=proc, sock_path=sock_path, started=time.time())
+        return None
+
+warm_pool = WarmPool()